@@ -4,45 +4,108 @@ http://www.ofai.at/~elias.pampalk/ma/documentation.html#ma_sone
 Created by Elias Pampalk, ported by Daniel Bedoya 2020-06-28
 """
 
+import functools
+from typing import NamedTuple
+
 import numpy as np
+import scipy.fft
+import scipy.sparse
 
 
 def ma_sone(wav, fs=44100, *,
             fft_size=1024, hop_size=512,
             outer_ear='terhardt', bark_type='table', db_max=96,
-            do_spread=True, do_sone=True):
+            do_spread=True, do_sone=True, fft_workers=1):
     """Compute the loudness of an audio file."""
+    blocks = ma_sone_blocks([wav], fs, fft_size=fft_size, hop_size=hop_size,
+                            outer_ear=outer_ear, bark_type=bark_type, db_max=db_max,
+                            do_spread=do_spread, do_sone=do_sone, fft_workers=fft_workers)
+    # A signal shorter than one fft frame yields no block
+    cb = get_sone_model(fs, fft_size, bark_type, outer_ear).cb
+    sone_db, tot_loudness = next(blocks, (np.zeros((cb, 0)), np.zeros((0, 2))))
+    return sone_db, tot_loudness
+
+
+def ma_sone_blocks(blocks, fs=44100, *,
+                   fft_size=1024, hop_size=512,
+                   outer_ear='terhardt', bark_type='table', db_max=96,
+                   do_spread=True, do_sone=True, fft_workers=1, first_frame=0):
+    """Compute the loudness of an audio stream given as successive blocks of samples.
+
+    Consecutive blocks must overlap by fft_size-hop_size samples and hold a whole number of hops beyond that
+    overlap (e.g. as produced by soundfile.blocks), so that every fft frame lies in exactly one block.
+    Yields the sone matrix and total loudness of each block, with times relative to the start of the stream,
+    which is fft frame first_frame of the recording.
+    """
+    model = get_sone_model(fs, fft_size, bark_type, outer_ear)
+
+    for wav in blocks:
+        # fft frames
+        frames = get_frames(wav, fft_size, hop_size)
+        if frames <= 0:  # Trailing block holding only the overlap
+            continue
+
+        # Rescale to dB max (default is 96dB = 2^16)
+        wav_db = wav * (10**(db_max/20))
+
+        # compute power spectrum
+        d_linear_outer_ear = get_power_spectrum(wav_db, fft_size, frames, hop_size, model.w_adb, workers=fft_workers)
+
+        # create sone
+        sone = model.band_matrix @ d_linear_outer_ear
+        if do_spread:  # apply spectral masking
+            sone = apply_spreading(model.spread, sone)
+        sone_db = array2db(sone)  # to dB
+
+        if do_sone:  # convert units from phones to sones
+            sone_db = phon2sone(sone_db)
+
+        # compute total loudness vector
+        tot_loudness = compute_total_loudness(sone_db, frames, hop_size, fs, first_frame=first_frame)
+        first_frame += frames
+
+        yield sone_db, tot_loudness
+
+
+class SoneModel(NamedTuple):
+    """Psychoacoustic tables of the loudness model for a given analysis setting."""
+
+    fft_freq: np.ndarray  # frequency of fft bins
+    cb: int  # number of critical bands
+    bark_upper: np.ndarray  # upper frequency of each critical band
+    spread: np.ndarray  # (cb, cb) spreading matrix
+    w_adb: np.ndarray  # (1, bins) outer ear weighting
+    band_matrix: scipy.sparse.csr_matrix  # (cb, bins) aggregation of fft bins into critical bands
+
+
+def get_sone_model(fs, fft_size, bark_type='table', outer_ear='terhardt'):
+    """Get the psychoacoustic model for the given setting.
+
+    Models are cached for the whole process, so their arrays are read-only.
+    """
+    if not isinstance(bark_type, str):
+        bark_type = tuple(bark_type)  # Lists are not hashable
+    return _compute_sone_model(fs, fft_size, bark_type, outer_ear)
+
+
+@functools.lru_cache(maxsize=32)
+def _compute_sone_model(fs, fft_size, bark_type, outer_ear):
+    """Compute the psychoacoustic model (see get_sone_model)."""
     # frequency of fft bins
     fft_freq = np.arange(0, (fft_size/2)+1)/fft_size*2*fs/2
 
     # critical band rate scale (Bark-scale)
     cb, bark_upper, _bark_center = compute_bark_scale(bark_type, fs)
+    bark_upper = np.ravel(bark_upper)
 
     # spreading function & outer ear model
     spread, w_adb = compute_spreading(cb, outer_ear, fft_freq)
 
-    # fft frames
-    frames = get_frames(wav, fft_size, hop_size)
+    band_matrix = compute_band_matrix(cb, fft_freq, bark_upper)
 
-    # Rescale to dB max (default is 96dB = 2^16)
-    wav_db = wav * (10**(db_max/20))
-
-    # compute power spectrum
-    d_linear_outer_ear, _d_linear = get_power_spectrum(wav_db, fft_size, frames, hop_size, w_adb)
-
-    # create sone
-    sone = compute_sone(cb, frames, fft_freq, bark_upper, d_linear_outer_ear)
-    if do_spread:  # apply spectral masking
-        sone = np.matmul(spread, sone)
-    sone_db = array2db(sone)  # to dB
-
-    if do_sone:  # convert units from phones to sones
-        sone_db = phon2sone(sone_db)
-
-    # compute total loudness vector
-    tot_loudness = compute_total_loudness(sone_db, frames, hop_size, fs)
-
-    return sone_db, tot_loudness
+    for array in (fft_freq, bark_upper, spread, w_adb, band_matrix.data, band_matrix.indices, band_matrix.indptr):
+        array.setflags(write=False)
+    return SoneModel(fft_freq, cb, bark_upper, spread, w_adb, band_matrix)
 
 
 def array2db(vector):
@@ -104,10 +167,9 @@ def compute_spreading(cb, outerear, fft_freq):
     schroeder et al., 1979, JASA,
     Optimizing digital speech coders by exploiting masking properties of the human ear.
     """
-    spread = np.zeros((cb, cb))
     cb_v = np.linspace(1, cb, cb, dtype=int)
-    for i in range(1, cb+1):
-        spread[i-1, :] = 10**((15.81+7.5*((i-cb_v)+0.474)-17.5*np.sqrt(1+((i-cb_v)+0.474)**2))/10)
+    i = cb_v[:, np.newaxis]
+    spread = 10**((15.81+7.5*((i-cb_v)+0.474)-17.5*np.sqrt(1+((i-cb_v)+0.474)**2))/10)
 
     w_adb = outer_ear_cases(outerear, fft_freq)
     return spread, w_adb
@@ -143,29 +205,45 @@ def get_frames(wav, fft_size, hop_size):
     return frames
 
 
-def get_power_spectrum(wav, fft_size, frames, hop_size, w_adb):
-    """Compute normalized powerspectrum."""
+def get_power_spectrum(wav, fft_size, frames, hop_size, w_adb, *, block_size=2048, workers=1):
+    """Compute normalized powerspectrum, weighted by the outer ear model w_adb.
+
+    Frames are taken as a strided view of the signal and transformed by blocks of block_size frames
+    to bound the size of temporary arrays. workers is passed on to scipy.fft (-1 to use all cores).
+    The outer ear weighting is applied block by block, so that the (bins, frames) result is the only full-size matrix.
+    """
     half_window_size = fft_size//2+1
-    dlinear = np.zeros((half_window_size, frames))  # data from fft (linear freq scale)
+    d_linear_outer_ear = np.empty((half_window_size, frames))  # data from fft (linear freq scale), outer ear weighted
     w = np.hanning(fft_size)
     scaling = np.sum(w)/2
-    for i in range(frames):  # fft
-        x = np.fft.fft(wav[hop_size*i:hop_size*i+fft_size]*w, n=fft_size)
-        dlinear[:, i] = abs(x[0:half_window_size]/scaling)**2  # normalized powerspectrum
-    d_linear_outer_ear = np.multiply(np.tile(np.transpose(w_adb), (1, dlinear.shape[1])), dlinear)  # outer ear
-    return d_linear_outer_ear, dlinear
+    frame_view = np.lib.stride_tricks.sliding_window_view(wav, fft_size)[::hop_size][:frames]
+    for start in range(0, frames, block_size):
+        x = scipy.fft.rfft(frame_view[start:start+block_size]*w, n=fft_size, axis=-1, workers=workers)
+        # normalized powerspectrum, then outer ear
+        d_linear_outer_ear[:, start:start+block_size] = np.transpose(w_adb) * (np.abs(x/scaling)**2).T
+    return d_linear_outer_ear
 
 
-def compute_sone(cb, frames, fft_freq, bark_upper, d_linear):
-    """Compute sone matrix from critical band scale and powerspectrum."""
-    sone = np.zeros((cb, frames))
-    k = 0
-    for i in range(0, cb):  # group into bark bands
-        idx = np.nonzero(fft_freq[k:len(fft_freq)] <= bark_upper[i])[0]
-        idx = idx + k
-        sone[i, :] = np.sum(d_linear[idx, :], axis=0)
-        k = np.max(idx)+1
-    return sone
+def compute_band_matrix(cb, fft_freq, bark_upper):
+    """Compute the sparse matrix summing fft bins into critical bands."""
+    # each band is a contiguous range of bins
+    band_end = np.searchsorted(fft_freq, bark_upper[:cb], side='right')
+    band_start = np.concatenate(([0], band_end[:-1]))
+    indptr = np.concatenate(([0], band_end - band_start)).cumsum()
+    indices = np.arange(band_end[-1])
+    return scipy.sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(cb, len(fft_freq)))
+
+
+def apply_spreading(spread, sone):
+    """Apply the spreading matrix to the sone matrix.
+
+    Bands are accumulated in a fixed order so that each frame's result does not depend on how many frames
+    are processed at once (which is not guaranteed by matmul).
+    """
+    spread_sone = np.zeros_like(sone)
+    for band in range(sone.shape[0]):
+        spread_sone += spread[:, band:band+1] * sone[band]
+    return spread_sone
 
 
 def phon2sone(sone_db):
@@ -180,7 +258,7 @@ def phon2sone(sone_db):
     return sone_db
 
 
-def compute_total_loudness(sone_db, frames, hop_size, fs):
+def compute_total_loudness(sone_db, frames, hop_size, fs, first_frame=0):
     """
     Compute total loudness as a vector with timestamps.
 
@@ -188,8 +266,10 @@ def compute_total_loudness(sone_db, frames, hop_size, fs):
     """
     tot_loudness = np.zeros((sone_db.shape[1], 2))
     factor = 0.15  # Masking factor
-    tot_loudness[:, 1] = (1-factor) * np.max(sone_db, 0) + factor * np.sum(sone_db, 0)
+    band_sum = np.zeros(sone_db.shape[1])
+    for band_loudness in sone_db:  # Summed band by band, like apply_spreading, for frame count invariance
+        band_sum += band_loudness
+    tot_loudness[:, 1] = (1-factor) * np.max(sone_db, 0) + factor * band_sum
 
-    for frame in range(frames):
-        tot_loudness[frame, 0] = frame * (hop_size/fs)  # time vector in sec
+    tot_loudness[:, 0] = np.arange(first_frame, first_frame + frames) * (hop_size/fs)  # time vector in sec
     return tot_loudness
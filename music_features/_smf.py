@@ -0,0 +1,116 @@
+"""Minimal Standard MIDI File reader for note and control change events.
+
+This avoids building a mido Message per event, which dominates the parsing of long performances.
+Only what is needed for the event tables of get_midi_events is decoded: note ons, note offs, control changes and
+tempo changes. Other events are skipped (but still count towards timing).
+"""
+import struct
+from typing import List, Tuple
+
+import numpy as np
+
+
+# Channel messages kept in the track tables (Status >> 4)
+NOTE_OFF = 0x8
+NOTE_ON = 0x9
+CONTROL_CHANGE = 0xB
+
+track_event_dtype = np.dtype([('Tick', np.int64), ('Delta', np.int64),
+                              ('Status', np.uint8), ('Data1', np.uint8), ('Data2', np.uint8)])
+tempo_change_dtype = np.dtype([('Tick', np.int64), ('Tempo', np.int64)])
+
+# Number of data bytes of each channel message (by Status >> 4) and system common/realtime message
+_data_lengths = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2,
+                 0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
+
+
+def read_smf(path: str) -> Tuple[int, List[np.ndarray], np.ndarray]:
+    """Read the note, control change and tempo events of a Standard MIDI File.
+
+    Args:
+        path (str): path to the midi file
+
+    Returns:
+        Tuple[int, List[np.ndarray], np.ndarray]: ticks per beat, events of each track (with dtype
+        track_event_dtype) and tempo changes of all tracks (with dtype tempo_change_dtype)
+    """
+    with open(path, 'rb') as midi_file:
+        data = memoryview(midi_file.read())
+
+    name, header_size = struct.unpack_from('>4sL', data)
+    if name != b'MThd':
+        raise OSError('MThd not found. Probably not a MIDI file')
+    _, track_count, ticks_per_beat = struct.unpack_from('>hhh', data, 8)
+
+    tracks = []
+    tempo_changes = []
+    position = 8 + header_size
+    for _ in range(track_count):
+        name, track_size = struct.unpack_from('>4sL', data, position)
+        if name != b'MTrk':
+            raise OSError('no MTrk header at start of track')
+        position += 8
+        tracks.append(read_track(data[position:position + track_size], tempo_changes))
+        position += track_size
+
+    tempo_changes = np.array(tempo_changes, dtype=tempo_change_dtype)
+    return ticks_per_beat, tracks, tempo_changes[np.argsort(tempo_changes['Tick'], kind='stable')]
+
+
+def read_track(data: memoryview, tempo_changes: List[Tuple[int, int]]) -> np.ndarray:
+    """Decode the events of a track chunk, appending its tempo changes to tempo_changes."""
+    events = []
+    tick = 0
+    running_status = None
+    position = 0
+    end = len(data)
+    while position < end:
+        # Variable-length delta time
+        delta = 0
+        while True:
+            byte = data[position]
+            position += 1
+            delta = (delta << 7) | (byte & 0x7F)
+            if byte < 0x80:
+                break
+        tick += delta
+
+        status = data[position]
+        if status < 0x80:
+            # Running status: the status byte is omitted and this is already the first data byte
+            if running_status is None:
+                raise OSError('running status without last_status')
+            status = running_status
+        else:
+            position += 1
+
+        if status == 0xFF:
+            meta_type = data[position]
+            position += 1
+            length, position = read_variable_int(data, position)
+            if meta_type == 0x51:
+                tempo_changes.append((tick, (data[position] << 16) | (data[position + 1] << 8) | data[position + 2]))
+            position += length
+        elif status == 0xF0 or status == 0xF7:
+            running_status = None
+            length, position = read_variable_int(data, position)
+            position += length
+        else:
+            kind = status >> 4
+            if kind != 0xF:
+                running_status = status
+            if kind == NOTE_ON or kind == NOTE_OFF or kind == CONTROL_CHANGE:
+                events.append((tick, delta, status, data[position], data[position + 1]))
+            position += _data_lengths[kind if kind != 0xF else status]
+    return np.array(events, dtype=track_event_dtype)
+
+
+def read_variable_int(data: memoryview, position: int) -> Tuple[int, int]:
+    """Decode a variable-length quantity, returning it and the position of the following byte."""
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
@@ -4,13 +4,17 @@ Compute tension using the spiral array model.
 Original code by R. Guo. Modified by D. Bedoya and C. Guichaoua.
 """
 
-import copy
+import functools
 import itertools
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pretty_midi
+import scipy.sparse
+
+from .get_reference import beats_until
+from .get_reference import get_reference
+from .get_reference import to_pretty_midi
 
 octave = 12
 
@@ -55,26 +59,50 @@ verticalStep = np.sqrt(2/15)  # 0.4
 radius = 1.0
 
 
-def cal_diameter(piano_roll, key_index, key_change_beat=-1, changed_key_index=-1):
+def note_activity(piano_roll):
+    """Get the piano roll as a 0/1 uint8 matrix, keeping sparse piano rolls sparse."""
+    if scipy.sparse.issparse(piano_roll):
+        return scipy.sparse.csc_matrix(piano_roll > 0, dtype=np.uint8)
+    return (np.asarray(piano_roll) > 0).astype(np.uint8)
 
-    diameters = []
 
-    for i in range(0, piano_roll.shape[1]):
-        indices = []
-        for index, j in enumerate(piano_roll[:, i]):
-            if j > 0:
-                if i / 4 > key_change_beat and key_change_beat != -1:
-                    shifted_index = index % 12 - changed_key_index
-                    if shifted_index < 0:
-                        shifted_index += 12
-                else:
-                    shifted_index = index % 12 - key_index
-                    if shifted_index < 0:
-                        shifted_index += 12
+# (128, 12) matrix mapping midi pitches to their pitch class
+pitch_class_matrix = (np.arange(128)[:, np.newaxis] % octave == np.arange(octave)).astype(int)
 
-                indices.append(note_index_to_pitch_index[shifted_index])
-        diameters.append(largest_distance(indices))
 
+def cal_diameter(piano_roll, key_index, key_change_beat=-1, changed_key_index=-1, beat_division=4):
+    """Compute the diameter of the notes of each time step of the piano roll.
+
+    Time steps after key_change_beat (if not -1) use changed_key_index instead of key_index,
+    with beat_division time steps per beat.
+    """
+    masks = pitch_class_masks(piano_roll)
+    change_step = len(masks) if key_change_beat == -1 else min(beat_division * key_change_beat + 1, len(masks))
+
+    diameters = np.empty(len(masks))
+    for steps, shift in ((slice(None, change_step), key_index), (slice(change_step, None), changed_key_index)):
+        diameters[steps] = pitch_class_set_diameters(shift)[masks[steps]]
+    return diameters
+
+
+def pitch_class_masks(piano_roll):
+    """Get the set of pitch classes of each time step of the piano roll as a 12-bit mask."""
+    classes = note_activity(piano_roll).T @ pitch_class_matrix
+    return (np.asarray(classes) > 0) @ (1 << np.arange(octave))
+
+
+@functools.lru_cache(maxsize=None)
+def pitch_class_set_diameters(shift):
+    """Get the diameter of all 4096 pitch class sets (indexed by 12-bit mask) for a key shift as a read-only array."""
+    positions = pitch_position_table(shift)[:octave]
+    distances = np.zeros((octave, octave))
+    for class1, class2 in itertools.combinations(range(octave), 2):
+        distances[class1, class2] = np.linalg.norm(positions[class1] - positions[class2])
+
+    has_class = (np.arange(2**octave)[:, np.newaxis] >> np.arange(octave)) & 1 > 0
+    pair_distances = distances * (has_class[:, :, np.newaxis] & has_class[:, np.newaxis, :])
+    diameters = pair_distances.max(axis=(1, 2))
+    diameters.setflags(write=False)
     return diameters
 
 
@@ -110,26 +138,7 @@ def piano_roll_to_ce(piano_roll, shift):
 
 
 def notes_to_ce(notes, shift):
-    indices = []
-
-    for index, j in enumerate(notes):
-        if j > 0:
-
-            shifted_index = index % 12 - shift
-            if shifted_index < 0:
-                shifted_index += 12
-
-            indices.append(note_index_to_pitch_index[shifted_index])
-
-    total = np.zeros(3)
-    count = 0
-    for index in indices:
-        total += pitch_index_to_position(index)
-        count += 1
-
-    if count != 0:
-        total /= count
-    return total
+    return cal_centroid(np.reshape(notes, (-1, 1)), shift)[0]
 
 
 def pitch_index_to_position(pitch_index):
@@ -151,6 +160,15 @@ def pitch_index_to_position(pitch_index):
     return np.array(pos)
 
 
+@functools.lru_cache(maxsize=None)
+def pitch_position_table(shift):
+    """Get the spiral array position of every midi pitch for a key shift as a read-only (128, 3) array."""
+    table = np.array([pitch_index_to_position(note_index_to_pitch_index[(index % octave - shift) % octave])
+                      for index in range(128)])
+    table.setflags(write=False)
+    return table
+
+
 def ce_sum(indices, start=None, end=None):
     if not start:
         start = 0
@@ -232,9 +250,40 @@ def cal_key(piano_roll, key_names, end_ratio=0.5):
     # use the song to the place of end_ratio to find the key
     # for classical it should be less than 0.2
     end = int(piano_roll.shape[1] * end_ratio)
-    distances = []
+    return key_from_histogram(pitch_class_histogram(piano_roll[:, :end]), key_names)
+
+
+def pitch_class_histogram(piano_roll):
+    """Count the notes of each pitch class over all time steps of the piano roll."""
+    note_counts = np.asarray(note_activity(piano_roll).sum(axis=1)).ravel()
+    return note_counts @ pitch_class_matrix
+
+
+def key_from_histogram(histogram, key_names):
+    """Find the key whose position is closest to the centroid of a pitch class histogram.
+
+    Returns:
+        (str, np.ndarray, int): name, position (of the C major or A minor key) and pitch shift of the key
+    """
+    key_positions, key_shifts, class_positions = key_table(tuple(key_names))
+    # Centroid of the notes for the shift of every key at once
+    centroids = np.tensordot(class_positions, histogram, axes=([1], [0])) / np.sum(histogram)
+    distances = np.linalg.norm(centroids - key_positions, axis=-1)
+
+    index = np.argmin(distances)
+    return key_names[index], key_positions[index].copy(), int(key_shifts[index])
+
+
+@functools.lru_cache(maxsize=None)
+def key_table(key_names):
+    """Get the positions and pitch shifts of keys, and the positions of the pitch classes for each key's shift.
+
+    All major keys are positioned as C major and all minor keys as A minor, their pitches being shifted instead.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): (keys, 3) positions, (keys,) shifts and (keys, 12, 3) class positions
+    """
     key_positions = []
-    key_indices = []
     key_shifts = []
     for name in key_names:
         key, mode = name.split()
@@ -270,17 +319,12 @@ def cal_key(piano_roll, key_names, end_ratio=0.5):
         else:
             key_shift_for_ce = np.argwhere(pitch_index_to_flat_names == key_shift_name)[0][0]
         key_shifts.append(key_shift_for_ce)
-        ce = piano_roll_to_ce(piano_roll[:, :end], key_shift_for_ce)
-        distance = np.linalg.norm(ce - key_pos)
-        distances.append(distance)
-        key_indices.append(key_index)
 
-    index = np.argmin(np.array(distances))
-    key_name = key_names[index]
-    key_pos = key_positions[index]
-    key_shift_for_ce = key_shifts[index]
-    # key_index = key_indices[index]
-    return key_name, key_pos, key_shift_for_ce
+    tables = (np.array(key_positions), np.array(key_shifts, dtype=int),
+              np.array([pitch_position_table(shift)[:octave] for shift in key_shifts]))
+    for table in tables:
+        table.setflags(write=False)
+    return tables
 
 
 def pianoroll_to_pitch(pianoroll):
@@ -291,14 +335,12 @@ def pianoroll_to_pitch(pianoroll):
 
 
 def note_to_index(pianoroll):
+    notes = scipy.sparse.csc_matrix(note_activity(pianoroll))
+    notes.sort_indices()
     note_ind = np.zeros((128, pianoroll.shape[1]))
-    for i in range(0, pianoroll.shape[1]):
-        step = []
-        for j, note in enumerate(pianoroll[:, i]):
-            if note != 0:
-                step.append(j)
-        if len(step) > 0:
-            note_ind[step[-1], i] = 1
+    sounding = np.flatnonzero(np.diff(notes.indptr))
+    # Highest note of each time step
+    note_ind[notes.indices[notes.indptr[sounding + 1] - 1], sounding] = 1
     return np.transpose(note_ind)
 
 
@@ -306,35 +348,71 @@ def merge_tension(metric, beat_indices, down_beat_indices, window_size=-1):
 
     # every bar window
     if window_size == -1:
-
-        new_metric = []
-
-        for i in range(len(down_beat_indices)-1):
-            new_metric.append(np.mean(metric[down_beat_indices[i]:down_beat_indices[i+1]], axis=0))
-
+        boundaries = np.asarray(down_beat_indices, dtype=int)
     else:
-        new_metric = []
-
-        for i in range(0, len(beat_indices) - window_size, window_size):
-            new_metric.append(np.mean(metric[beat_indices[i]:beat_indices[i + window_size]], axis=0))
+        window_count = len(range(0, len(beat_indices) - window_size, window_size))
+        boundaries = np.asarray(beat_indices, dtype=int)[::window_size][:window_count + 1]
 
-    return np.array(new_metric)
+    if len(boundaries) < 2:
+        return np.array([])
+    return window_means(metric, boundaries[:-1], boundaries[1:])
 
 
 def moving_average(tension, window=4):
 
     # size moving window, the output size is the same
-    outputs = []
     zeros = np.zeros((window,), dtype=tension.dtype)
 
     tension = np.concatenate([tension, zeros], axis=0)
-    for i in range(0, tension.shape[0]-window+1):
-        outputs.append(np.mean(tension[i:i+window]))
-    return np.array(outputs)
+    # Adding the shifted windows in order sums each window the same way as np.mean
+    count = tension.shape[0] - window + 1
+    total = tension[:count].copy()
+    for shift in range(1, window):
+        total += tension[shift:shift+count]
+    return total / window
+
+
+def window_sums(values, starts, ends):
+    """Sum values along the first axis over each window [start, end).
+
+    The windows are summed by a single np.add.reduceat, so the cost is linear in the total length of the windows.
+    The sums are the same as np.sum over each window up to rounding (the order of additions may differ).
+    """
+    values = np.asarray(values)
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    if len(starts) == 0:
+        return np.zeros((0, *values.shape[1:]), dtype=values.dtype)
+    # A trailing row keeps the indices valid when a window ends with the values
+    padded = np.concatenate([values, np.zeros((1, *values.shape[1:]), dtype=values.dtype)])
+    # Interleaving starts and ends makes every other reduceat segment a window
+    sums = np.add.reduceat(padded, np.column_stack([starts, ends]).ravel(), axis=0)[::2]
+    sums[ends <= starts] = 0
+    return sums
+
+
+def window_means(values, starts, ends):
+    """Average values along the first axis over each window [start, end), empty windows being nan."""
+    values = np.asarray(values)
+    counts = np.maximum(np.asarray(ends) - np.asarray(starts), 0)
+    sums = window_sums(values, starts, ends)
+    with np.errstate(invalid='ignore'):
+        return sums / counts.reshape(-1, *(1,)*(values.ndim-1))
 
 
 def cal_tension(pm, piano_roll, beat_data, window_size=1, *,
                 key_name=None, key_changed=False, end_ratio=0.5, **kwargs):
+    return cal_tension_windows(pm, piano_roll, beat_data, (window_size,), key_name=key_name, key_changed=key_changed,
+                               end_ratio=end_ratio, **kwargs)[window_size]
+
+
+def cal_tension_windows(pm, piano_roll, beat_data, window_sizes=(1, -1), *,
+                        key_name=None, key_changed=False, end_ratio=0.5, **kwargs):
+    """Compute the tension for several window sizes, sharing the key, centroids and diameters of each time step.
+
+    Returns:
+        dict: the result of cal_tension for each window size
+    """
     # try:
     key_name = key_name or all_key_names
     # all the major key pos is C major pos, all the minor key pos is a minor pos
@@ -344,18 +422,33 @@ def cal_tension(pm, piano_roll, beat_data, window_size=1, *,
 
     kc = windowDetectKey(beat_data, centroids, key_pos, piano_roll, note_shift, end_ratio, pm, key_name, key_changed)
 
-    centroids = cal_centroid(piano_roll, note_shift, kc['key_change_beat'], kc['changed_note_shift'])
+    centroids = cal_centroid(piano_roll, note_shift, kc['key_change_beat'], kc['changed_note_shift'],
+                             beat_data.get('beat_division', 4))
+    step_diameters = cal_diameter(piano_roll, note_shift, kc['key_change_beat'], kc['changed_note_shift'],
+                                  beat_data.get('beat_division', 4))
+
+    tensions = {}
+    for window_size in window_sizes:
+        merged_centroids = merge_tension(
+            centroids, beat_data['beat_indices'], beat_data['down_beat_indices'], window_size=window_size)
+        diameters = merge_tension(step_diameters, beat_data['beat_indices'], beat_data['down_beat_indices'],
+                                  window_size)
+        tensions[window_size] = window_tension(beat_data, window_size, merged_centroids, diameters,
+                                               key_name, key_pos, kc)
+    return tensions
+
+    # except (ValueError, EOFError, IndexError, OSError, KeyError, ZeroDivisionError) as e:
+    #     exception_str = 'Unexpected error in ' + file_name + ':\n', e, sys.exc_info()[0]
+    #     logger.info(exception_str)
+
 
-    merged_centroids = merge_tension(
-        centroids, beat_data['beat_indices'], beat_data['down_beat_indices'], window_size=window_size)
+def window_tension(beat_data, window_size, merged_centroids, diameters, key_name, key_pos, kc):
+    """Assemble the tension of windows from their mean centroids and diameters, in the format of cal_tension."""
     merged_centroids = np.array(merged_centroids)
 
     window_time, total_tension = cal_key_diff(beat_data, window_size, merged_centroids, key_pos, kc)
     tension_time = window_time[:len(total_tension)]
 
-    diameters = cal_diameter(piano_roll, note_shift, kc['key_change_beat'], kc['changed_note_shift'])
-    diameters = merge_tension(diameters, beat_data['beat_indices'], beat_data['down_beat_indices'], window_size)
-
     centroid_diff = np.diff(merged_centroids, axis=0)
     np.nan_to_num(centroid_diff, copy=False)
 
@@ -364,9 +457,154 @@ def cal_tension(pm, piano_roll, beat_data, window_size=1, *,
 
     return (tension_time, total_tension, diameters, centroid_diff, key_name, kc)
 
-    # except (ValueError, EOFError, IndexError, OSError, KeyError, ZeroDivisionError) as e:
-    #     exception_str = 'Unexpected error in ' + file_name + ':\n', e, sys.exc_info()[0]
-    #     logger.info(exception_str)
+
+def cal_tension_events(pm, beat_data, window_sizes=(1, -1), *,
+                       key_name=None, key_changed=False, end_ratio=0.5, **kwargs):
+    """Compute the tension for several window sizes from the notes' own timing instead of a fixed grid.
+
+    Centroids and diameters are computed once for each segment between consecutive note on/off events,
+    and averaged over each window weighted by their duration.
+
+    Returns:
+        dict: the result of cal_tension for each window size
+    """
+    boundaries, piano_roll = get_note_segments(pm)
+    beat_time = beat_data['beat_time']
+    down_beat_time = beat_data['down_beat_time']
+    grid = beat_data['sixteenth_time']
+
+    key_name = key_name or all_key_names
+    end = int(len(grid) * end_ratio)
+    key_name, key_pos, note_shift = key_from_histogram(
+        segment_histogram(piano_roll, boundaries, 0, grid[end] if end < len(grid) else np.inf), key_name)
+    centroids = cal_centroid(piano_roll, note_shift)
+    diameters = cal_diameter(piano_roll, note_shift)
+
+    kc = {'changed_note_shift': -1,
+          'changed_key_pos': '',
+          'changed_key_name': '',
+          'key_change_beat': -1,
+          'change_time': -1,
+          'key_change_bar': -1}
+    if key_changed:
+        # use a bar window to detect key change
+        merged_centroids = time_window_means(centroids, boundaries, down_beat_time[:-1], down_beat_time[1:])
+        key_diff = np.linalg.norm(merged_centroids - key_pos, axis=-1)
+        key_diff[np.linalg.norm(merged_centroids, axis=-1) == 0] = 0
+        merged_diameters = time_window_means(diameters, boundaries, down_beat_time[:-1], down_beat_time[1:])
+
+        key_change_bar = detect_key_change(key_diff, merged_diameters, start_ratio=end_ratio)
+        if key_change_bar != -1:
+            change_time = down_beat_time[key_change_bar]
+            changed_key_name, changed_key_pos, changed_note_shift = key_from_histogram(
+                segment_histogram(piano_roll, boundaries, change_time, np.inf), all_key_names)
+            if changed_key_name != key_name:
+                kc = {'changed_note_shift': changed_note_shift,
+                      'changed_key_pos': changed_key_pos,
+                      'changed_key_name': changed_key_name,
+                      'key_change_beat': np.argwhere(beat_time == change_time)[0][0],
+                      'change_time': change_time,
+                      'key_change_bar': key_change_bar}
+                changed = np.searchsorted(boundaries[:-1], change_time)  # First segment starting after the change
+                centroids[changed:] = cal_centroid(piano_roll[:, changed:], changed_note_shift)
+                diameters[changed:] = cal_diameter(piano_roll[:, changed:], changed_note_shift)
+
+    tensions = {}
+    for window_size in window_sizes:
+        if window_size == -1:
+            edges = down_beat_time
+        else:
+            window_count = len(range(0, len(beat_time) - window_size, window_size))
+            edges = beat_time[::window_size][:window_count + 1]
+        merged_centroids = time_window_means(centroids, boundaries, edges[:-1], edges[1:])
+        merged_diameters = time_window_means(diameters, boundaries, edges[:-1], edges[1:])
+        tensions[window_size] = window_tension(beat_data, window_size, merged_centroids, merged_diameters,
+                                               key_name, key_pos, kc)
+    return tensions
+
+
+def get_note_segments(pm, fs=100):
+    """Split the score at every note start and end, and find the notes sounding in each segment.
+
+    Note timing (including the sustain pedal) is quantized to 1/fs seconds as for get_piano_roll.
+    As in get_piano_roll, instruments with pitch bends are rendered by pretty_midi, since bent pitches spread over
+    rows: their notes are split wherever the rendered pitch changes.
+
+    Returns:
+        (np.ndarray, scipy.sparse.csc_matrix): (segments+1,) segment boundaries in seconds and
+            sparse (128, segments) uint8 piano roll of the segments
+    """
+    starts = []
+    ends = []
+    pitches = []
+    for instrument in pm.instruments:
+        if not instrument.notes or instrument.is_drum:
+            continue
+        if any(abs(bend.pitch) >= 1 for bend in instrument.pitch_bends):  # Bent pitches spread over rows
+            note_pitches, note_starts, note_ends = piano_roll_runs(instrument.get_piano_roll(fs=fs) > 0)
+            starts.append(note_starts)
+            ends.append(note_ends)
+            pitches.append(note_pitches)
+            continue
+        note_starts, note_ends, note_pitches = np.array([(int(note.start*fs), int(note.end*fs), note.pitch)
+                                                         for note in instrument.notes if note.velocity > 0],
+                                                        dtype=int).reshape(-1, 3).T
+        note_ends = extend_pedaled_notes(instrument, note_starts, note_ends, fs)
+        sounding = note_ends > note_starts
+        starts.append(note_starts[sounding])
+        ends.append(note_ends[sounding])
+        pitches.append(note_pitches[sounding])
+    starts = np.concatenate(starts or [[]]).astype(int)
+    ends = np.concatenate(ends or [[]]).astype(int)
+
+    boundaries = np.unique(np.concatenate([starts, ends]))
+    piano_roll = intervals_to_csc(np.concatenate(pitches or [[]]), np.searchsorted(boundaries, starts),
+                                  np.searchsorted(boundaries, ends), max(len(boundaries) - 1, 0))
+    return boundaries / fs, piano_roll
+
+
+def piano_roll_runs(active):
+    """Find the runs of consecutive active frames of each row of a boolean piano roll.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): row, first frame and end frame (exclusive) of each run
+    """
+    changes = np.diff(np.pad(active, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, run_starts = np.nonzero(changes == 1)
+    _, run_ends = np.nonzero(changes == -1)  # Row-major order pairs each end with its start
+    return rows, run_starts, run_ends
+
+
+def segment_histogram(piano_roll, boundaries, start_time, end_time):
+    """Sum the sounding duration of each pitch class of a segment piano roll between start_time and end_time."""
+    overlaps = np.clip(np.minimum(boundaries[1:], end_time) - np.maximum(boundaries[:-1], start_time), 0, None)
+    return (note_activity(piano_roll) @ overlaps) @ pitch_class_matrix
+
+
+def time_window_means(values, boundaries, starts, ends):
+    """Average values of segments over each time window [start, end), weighted by their duration in the window.
+
+    values holds one value (or row) per segment between consecutive boundaries, and is zero outside of the segments.
+    Empty windows are nan.
+    """
+    values = np.asarray(values, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    if len(values) == 0:
+        return np.zeros((len(starts), *values.shape[1:]))
+    durations = np.diff(boundaries).reshape(-1, *(1,)*(values.ndim-1))
+    integrals = np.concatenate([np.zeros((1, *values.shape[1:])), np.cumsum(values * durations, axis=0)])
+
+    def integral(times):
+        """Integrate the values from the first boundary up to each time."""
+        times = np.clip(times, boundaries[0], boundaries[-1])
+        segments = np.clip(np.searchsorted(boundaries, times, side='right') - 1, 0, len(values) - 1)
+        elapsed = (times - boundaries[segments]).reshape(-1, *(1,)*(values.ndim-1))
+        return integrals[segments] + values[segments] * elapsed
+
+    lengths = (ends - starts).reshape(-1, *(1,)*(values.ndim-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(lengths > 0, (integral(ends) - integral(starts)) / lengths, np.nan)
 
 
 def cal_key_diff(beat_data, window_size, merged_centroids, key_pos, kc):
@@ -420,7 +658,7 @@ def windowDetectKey(beat_data, centroids, key_pos, piano_roll, note_shift, end_r
             key_change_beat = np.argwhere(beat_time == down_beat_time[key_change_bar])[0][0]
             change_time = down_beat_time[key_change_bar]
             changed_key_name, changed_key_pos, changed_note_shift = get_key_index_change(
-                pm, change_time, sixteenth_time)
+                piano_roll, change_time, sixteenth_time)
             if changed_key_name == key_name:
                 changed_note_shift = -1
                 changed_key_name = ''
@@ -461,19 +699,12 @@ def export_plots(new_output_folder, file_name, total_tension, diameters, centroi
                                              base_name[:-4] + '_centroid_diff.png'))
 
 
-def get_key_index_change(pm, start_time, sixteenth_time):
-
-    new_pm = copy.deepcopy(pm)
-    for instrument in new_pm.instruments:
-        for i, note in enumerate(instrument.notes):
-            if note.start > start_time:
-                instrument.notes = instrument.notes[i:]
-                break
-
-    piano_roll = get_piano_roll(new_pm, sixteenth_time)
+def get_key_index_change(piano_roll, start_time, sixteenth_time):
+    """Find the key of the piano roll from start_time onwards."""
+    change_step = np.searchsorted(sixteenth_time, start_time)
     key_name = all_key_names
 
-    key_name, key_pos, note_shift = cal_key(piano_roll, key_name, end_ratio=1)
+    key_name, key_pos, note_shift = cal_key(piano_roll[:, change_step:], key_name, end_ratio=1)
 
     return key_name, key_pos, note_shift
 
@@ -491,53 +722,124 @@ def note_pitch(melody_track):
     return pitch_sum
 
 
-def get_piano_roll(pm, beat_times):
-    piano_roll = pm.get_piano_roll(times=beat_times)
-    np.nan_to_num(piano_roll, copy=False)
-    piano_roll = piano_roll > 0
-    piano_roll = piano_roll.astype(int)
-
-    return piano_roll
+def get_piano_roll(pm, beat_times, fs=100):
+    """Compute which pitches sound in each interval between beat_times as a sparse (128, times) uint8 matrix.
 
+    The result is the same as thresholding pm.get_piano_roll(times=beat_times), but is built from the note intervals
+    without rendering a dense piano roll.
+    """
+    grid = np.round(np.asarray(beat_times) * fs).astype(int)
+    column_starts = grid[:-1]
+    column_ends = np.maximum(grid[1:], column_starts + 1)
 
-def cal_centroid(piano_roll, key_index, key_change_beat=-1, changed_key_index=-1):
-
-    centroids = []
-    for time_step in range(0, piano_roll.shape[1]):
-
-        roll = piano_roll[:, time_step]
+    pitches = []
+    first_columns = []
+    end_columns = []
+    for instrument in pm.instruments:
+        if not instrument.notes or instrument.is_drum:
+            continue
+        if any(abs(bend.pitch) >= 1 for bend in instrument.pitch_bends):  # Bent pitches spread over rows
+            pitch, column = np.nonzero(instrument.get_piano_roll(fs=fs, times=beat_times) > 0)
+            pitches.append(pitch)
+            first_columns.append(column)
+            end_columns.append(column + 1)
+            continue
 
-        if key_change_beat != -1:
-            if time_step / 4 > key_change_beat:
-                centroids.append(notes_to_ce(roll, changed_key_index))
-            else:
-                centroids.append(notes_to_ce(roll, key_index))
-        else:
-            centroids.append(notes_to_ce(roll, key_index))
+        end_time = max(instrument.get_end_time(), beat_times[-1])
+        starts, ends, pitch = np.array([(int(note.start*fs), int(note.end*fs), note.pitch)
+                                        for note in instrument.notes if note.velocity > 0], dtype=int).reshape(-1, 3).T
+        ends = extend_pedaled_notes(instrument, starts, ends, fs)
+        sounding = ends > starts  # Notes shorter than a frame are not rendered
+        starts, ends, pitch = starts[sounding], ends[sounding], pitch[sounding]
+        # Columns whose interval overlaps the note, among those starting within the instrument's roll
+        first_columns.append(np.searchsorted(column_ends, starts, side='right'))
+        end_columns.append(np.searchsorted(column_starts, np.minimum(ends, int(fs*end_time)), side='left'))
+        pitches.append(pitch)
+
+    # Like pretty_midi, a score without any note has no time step
+    column_count = len(grid) if any(instrument.notes for instrument in pm.instruments) else 0
+    return intervals_to_csc(np.concatenate(pitches or [[]]), np.concatenate(first_columns or [[]]),
+                            np.concatenate(end_columns or [[]]), column_count)
+
+
+def extend_pedaled_notes(instrument, starts, ends, fs=100, pedal_threshold=64):
+    """Extend the end frames of notes held by the sustain pedal until the pedal is released, as pretty_midi does."""
+    pedal_starts = []
+    pedal_ends = []
+    is_pedal_on = False
+    for cc in instrument.control_changes:
+        if cc.number != 64:
+            continue
+        time_now = int(cc.time*fs)
+        is_current_pedal_on = cc.value >= pedal_threshold
+        if not is_pedal_on and is_current_pedal_on:
+            pedal_starts.append(time_now)
+            is_pedal_on = True
+        elif is_pedal_on and not is_current_pedal_on:
+            pedal_ends.append(time_now)
+            is_pedal_on = False
+    pedal_starts = np.array(pedal_starts[:len(pedal_ends)], dtype=int)
+    pedal_ends = np.array(pedal_ends, dtype=int)
+    if len(pedal_ends) == 0:
+        return ends
+
+    # Last pedal pressed before the note stops sounding; it holds the note if it is released after the note starts
+    last_pedal = np.searchsorted(pedal_starts, ends, side='left') - 1
+    pedal_release = np.where(last_pedal >= 0, pedal_ends[last_pedal], 0)
+    held = (pedal_release > starts) & (ends > starts)  # The pedal holds notes sounding while it is pressed
+    return np.where(held, np.maximum(ends, pedal_release), ends)
+
+
+def intervals_to_csc(rows, first_columns, end_columns, column_count):
+    """Build a sparse (128, column_count) uint8 matrix of ones over each [first_column, end_column) of each row."""
+    rows = np.asarray(rows, dtype=int)
+    first_columns = np.asarray(first_columns, dtype=int)
+    lengths = np.maximum(np.asarray(end_columns, dtype=int) - first_columns, 0)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    columns = np.arange(lengths.sum()) - offsets + np.repeat(first_columns, lengths)
+    # Column-major cell numbers, sorted and without duplicates as required by the CSC format
+    cells = np.unique(columns * 128 + np.repeat(rows, lengths))
+    indptr = np.searchsorted(cells // 128, np.arange(column_count + 1))
+    return scipy.sparse.csc_matrix((np.ones(len(cells), dtype=np.uint8), cells % 128, indptr),
+                                   shape=(128, column_count))
+
+
+def cal_centroid(piano_roll, key_index, key_change_beat=-1, changed_key_index=-1, beat_division=4):
+    """Compute the centroid of the notes of each time step of the piano roll as a (time steps, 3) array.
+
+    Time steps after key_change_beat (if not -1) use changed_key_index instead of key_index,
+    with beat_division time steps per beat.
+    """
+    notes = note_activity(piano_roll).T
+    change_step = notes.shape[0] if key_change_beat == -1 else min(beat_division * key_change_beat + 1, notes.shape[0])
+
+    centroids = np.empty((notes.shape[0], 3))
+    for steps, shift in ((slice(None, change_step), key_index), (slice(change_step, None), changed_key_index)):
+        centroids[steps] = notes[steps] @ pitch_position_table(shift)
+    counts = np.asarray(notes.sum(axis=1)).ravel()
+    centroids /= np.maximum(counts, 1)[:, np.newaxis]
     return centroids
 
 
 def detect_key_change(key_diff, diameter, start_ratio=0.5):
 
     # 8 bar window
+    indices = np.arange(8, key_diff.shape[0]-8)
+    previous_sounding = window_sums(key_diff != 0, indices-4, indices) > 0
+    current_sounding = window_sums(key_diff != 0, indices, indices+4) > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = window_means(key_diff, indices, indices+4) / window_means(key_diff, indices-4, indices)
+
     key_diff_ratios = []
     # diameter_ratios = []
-    fill_one = False
     steps = 0
-    for i in range(8, key_diff.shape[0]-8):
-        if fill_one and steps > 0:
+    for ratio, sounding in zip(ratios, previous_sounding & current_sounding):
+        if steps > 0:
             key_diff_ratios.append(1)
             steps -= 1
-            if steps == 0:
-                fill_one = False
-            continue
-
-        if np.any(key_diff[i-4:i]) and np.any(key_diff[i:i+4]):
-            previous = np.mean(key_diff[i-4:i])
-            current = np.mean(key_diff[i:i+4])
-            key_diff_ratios.append(current / previous)
+        elif sounding:
+            key_diff_ratios.append(ratio)
         else:
-            fill_one = True
             steps = 4
 
     # for i in range(8,diameter.shape[0] - 8):
@@ -549,13 +851,11 @@ def detect_key_change(key_diff, diameter, start_ratio=0.5):
     #     else:
     #         diameter_ratios.append(1)
 
-    for i in range(int(len(key_diff_ratios) * start_ratio), len(key_diff_ratios)-2):
-
-        if np.mean(key_diff_ratios[i:i+4]) > 2:
-            key_diff_change_bar = i
-            break
-    else:
-        key_diff_change_bar = -1
+    key_diff_ratios = np.array(key_diff_ratios, dtype=float)
+    candidates = np.arange(int(len(key_diff_ratios) * start_ratio), len(key_diff_ratios)-2)
+    ratio_means = window_means(key_diff_ratios, candidates, np.minimum(candidates+4, len(key_diff_ratios)))
+    changes = candidates[ratio_means > 2]
+    key_diff_change_bar = int(changes[0]) if len(changes) else -1
 
     # for i in range(int(len(diameter_ratios) * start_ratio), len(diameter_ratios) - 2):
     #
@@ -598,38 +898,39 @@ def remove_drum_track(pm):
 
 
 def get_beat_time(pm, beat_division=4):
-    beats = pm.get_beats()
+    return divide_beats(pm.get_beats(), pm.get_downbeats(), beat_division)
 
+
+def divide_beats(beats, down_beats, beat_division=4):
+    """Compute the time steps (beat_division per beat) of the beat grid, and the indices of beats and downbeats."""
     beats = np.unique(beats, axis=0)
 
-    divided_beats = []
-    for i in range(len(beats) - 1):
-        for j in range(beat_division):
-            divided_beats.append((beats[i + 1] - beats[i]) / beat_division * j + beats[i])
-    divided_beats.append(beats[-1])
-    divided_beats = np.unique(divided_beats, axis=0)
+    # beat_division evenly spaced steps from each beat to the next
+    steps = (np.diff(beats) / beat_division)[:, np.newaxis] * np.arange(beat_division) + beats[:-1, np.newaxis]
+    divided_beats = np.unique(np.append(steps.ravel(), beats[-1]))
 
-    beat_indices = []
-    for beat in beats:
-        beat_indices.append(np.argwhere(divided_beats == beat)[0][0])
+    beat_indices = np.searchsorted(divided_beats, beats)
 
-    down_beats = pm.get_downbeats()
     if divided_beats[-1] > down_beats[-1]:
         down_beats = np.append(down_beats, down_beats[-1] - down_beats[-2] + down_beats[-1])
 
     down_beats = np.unique(down_beats, axis=0)
 
-    down_beat_indices = []
-    for down_beat in down_beats:
-
-        down_beat_indices.append(np.argmin(np.abs(down_beat - divided_beats)))
+    # Nearest step to each downbeat, the earlier one in case of a tie
+    after = np.clip(np.searchsorted(divided_beats, down_beats), 1, len(divided_beats) - 1)
+    before = after - 1
+    down_beat_indices = np.where(
+        np.abs(down_beats - divided_beats[before]) <= np.abs(down_beats - divided_beats[after]), before, after)
+    if len(divided_beats) == 1:
+        down_beat_indices = np.zeros(len(down_beats), dtype=int)
 
-    return np.array(divided_beats), np.array(beats), np.array(down_beats), beat_indices, down_beat_indices
+    return divided_beats, beats, down_beats, beat_indices, down_beat_indices
 
 
-def extract_notes(file_name, track_num):
-    pm = pretty_midi.PrettyMIDI(file_name)
-    pm = remove_drum_track(pm)
+def extract_notes(file_name, track_num, beat_division=4, resolution='grid'):
+    # The reference midi (or reference file) is only parsed once, see get_reference
+    reference = get_reference(file_name)
+    pm = remove_drum_track(to_pretty_midi(reference))
 
     # if len(pm.time_signature_changes) > 1:
     #     logger.info(f'multiple time signature, skip {file_name}')
@@ -646,14 +947,20 @@ def extract_notes(file_name, track_num):
         #                    f'less than the required track num {track_num}. Use all the tracks')
         pm.instruments = pm.instruments[:track_num]
 
-    sixteenth_time, beat_time, down_beat_time, beat_indices, down_beat_indices = get_beat_time(pm, beat_division=4)
+    # The beats depend on the end of the kept instruments
+    beats, down_beats = beats_until(reference, max((instrument.get_end_time() for instrument in pm.instruments),
+                                                   default=0.))
+    sixteenth_time, beat_time, down_beat_time, beat_indices, down_beat_indices = divide_beats(
+        beats, down_beats, beat_division)
 
-    piano_roll = get_piano_roll(pm, sixteenth_time)
+    # The events resolution builds its own piano roll between note events (see get_note_segments)
+    piano_roll = get_piano_roll(pm, sixteenth_time) if resolution != 'events' else None
     beat_data = {'sixteenth_time': sixteenth_time,
                  'beat_time': beat_time,
                  'down_beat_time': down_beat_time,
                  'beat_indices': beat_indices,
-                 'down_beat_indices': down_beat_indices
+                 'down_beat_indices': down_beat_indices,
+                 'beat_division': beat_division
                  }
 
     return [pm, piano_roll, beat_data]
@@ -8,7 +8,9 @@ from doit import task_params
 from music_features import get_alignment
 from music_features import get_beats
 from music_features import get_loudness
+from music_features import get_midi_events
 from music_features import get_onset_velocity
+from music_features import get_reference
 from music_features import get_sustain
 from music_features import get_tension
 from music_features.util import collect_kw_parameters
@@ -113,8 +115,8 @@ def gen_tasks_template(module):
 
 
 # Register the generators in the module namespace
-submodules = (get_loudness, get_onset_velocity, get_sustain, get_tension,
-              get_beats, get_alignment)
+submodules = (get_loudness, get_midi_events, get_onset_velocity, get_sustain, get_tension,
+              get_beats, get_alignment, get_reference)
 for module in submodules:
     name = module.__name__[19:]  # Assumes get_X convention is respected
     globals()[f"task_{name}"] = gen_tasks_template(module)
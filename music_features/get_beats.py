@@ -2,12 +2,15 @@
 from typing import List, Tuple
 import warnings
 
+from doit.tools import config_changed
 import numpy as np
 import pandas as pd
-import pretty_midi as pm
 import scipy.interpolate
 
 from music_features import get_alignment
+from music_features.get_reference import get_reference
+from music_features.util import add_suffix
+from music_features.util import expand_sweep
 
 
 def get_beats(alignment: pd.DataFrame, reference_beats, *,
@@ -21,7 +24,8 @@ def get_beats(alignment: pd.DataFrame, reference_beats, *,
         if anomalies == []:
             return (beats, ignored)
         else:
-            alignment, new_ignored = attempt_correction(alignment, reference_beats, anomalies)
+            alignment, new_ignored = attempt_correction(alignment, reference_beats, anomalies,
+                                                        verbose=kwargs.get('verbose', True))
             ignored = pd.concat([ignored, new_ignored])
             beats = interpolate_beats(alignment, reference_beats)
 
@@ -41,17 +45,13 @@ def write_beats(beat_path: str, beats: pd.DataFrame) -> None:
 
 
 def get_beat_reference_pm(ref_filename: str):
-    """Find the beats in the reference according to pretty-midi."""
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", RuntimeWarning)
-        pretty = pm.PrettyMIDI(ref_filename)
-    return np.round(np.array(pretty.get_beats()) * 1000)  # seconds to milliseconds
+    """Find the beats in the reference (midi or reference file, see get_reference) according to pretty-midi."""
+    return np.round(get_reference(ref_filename).beats * 1000)  # seconds to milliseconds
 
 
 def get_bar_reference_pm(ref_filename: str):
-    """Find the bar lines in the reference according to pretty-midi."""
-    pretty = pm.PrettyMIDI(ref_filename)
-    return np.round(np.array(pretty.get_downbeats()) * 1000)  # seconds to milliseconds
+    """Find the bar lines in the reference (midi or reference file, see get_reference) according to pretty-midi."""
+    return np.round(get_reference(ref_filename).downbeats * 1000)  # seconds to milliseconds
 
 
 def interpolate_beats(alignment: pd.DataFrame, reference_beats: List[int]):
@@ -71,25 +71,30 @@ def interpolate_beats(alignment: pd.DataFrame, reference_beats: List[int]):
     # Do not extrapolate with a spline!
     interpolation[(reference_beats < ticks.min()) | (reference_beats > ticks.max())] = np.nan
 
-    beats = pd.DataFrame({"time": interpolation, "interpolated": [tick not in ticks for tick in reference_beats]})
+    beats = pd.DataFrame({"time": interpolation, "interpolated": np.isin(reference_beats, ticks, invert=True)})
     return beats
 
 
 def attempt_correction(alignment: pd.DataFrame, reference_beats: List[int], anomalies: List[Tuple[int, int]],
                        *, verbose=True) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Attempt to correct the beat extraction by removing the values causing outliers."""
-    mask = alignment.score_time > 0
-
-    filtered = pd.DataFrame()
-    for index_before, index_after in anomalies:
-        # Find range to erase
-        range_start = alignment[alignment.score_time <= reference_beats[index_before]].iloc[-1].score_time
-        range_end = alignment[alignment.score_time >= reference_beats[index_after]].iloc[0].score_time
-
-        mask &= ((alignment.score_time < range_start) | (alignment.score_time > range_end))
+    score_time = alignment.score_time.to_numpy()
+    mask = score_time > 0
+
+    if anomalies:
+        indices_before, indices_after = np.array(anomalies).T
+        reference_beats = np.asarray(reference_beats)
+        # Find ranges to erase: from the last note (in alignment order) at or before the beat before the anomaly,
+        # to the first note at or after the beat after it
+        last_at_or_before = np.searchsorted(np.minimum.accumulate(score_time[::-1])[::-1],
+                                            reference_beats[indices_before], side='right') - 1
+        first_at_or_after = np.searchsorted(np.maximum.accumulate(score_time), reference_beats[indices_after])
+        if (last_at_or_before < 0).any() or (first_at_or_after >= len(score_time)).any():
+            raise IndexError("No note to delimit the range to erase around an anomaly")
+        mask &= ~in_ranges(score_time, score_time[last_at_or_before], score_time[first_at_or_after])
     # Ensure first and last are preserved
-    mask.iloc[0] = True
-    mask.iloc[-1] = True
+    mask[0] = True
+    mask[-1] = True
 
     filtered = alignment.loc[~mask]
     alignment = alignment.loc[mask]
@@ -100,6 +105,15 @@ def attempt_correction(alignment: pd.DataFrame, reference_beats: List[int], anom
     return alignment, filtered
 
 
+def in_ranges(values: np.ndarray, range_starts: np.ndarray, range_ends: np.ndarray) -> np.ndarray:
+    """Test whether each value lies in any of the (closed) ranges."""
+    order = np.argsort(range_starts)
+    range_starts = range_starts[order]
+    range_ends = np.maximum.accumulate(range_ends[order])  # Furthest end among ranges starting before each start
+    last_started = np.searchsorted(range_starts, values, side='right') - 1
+    return (last_started >= 0) & (values <= range_ends[np.maximum(last_started, 0)])
+
+
 def remove_outliers_and_duplicates(alignment: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
     """Prefilter data by removing duplicates and resorting."""
     # TODO: determine better which note to use when notes share a tatum
@@ -115,8 +129,8 @@ def find_outliers(beats, *, factor=4, verbose=True):
     inter_beat_intervals = np.diff(beats)
     mean_IBI = np.mean(inter_beat_intervals)
     # Only check values too quick, slow values are likely valid
-    anomaly_indices = [(i, i+1) for (i, ibi) in enumerate(inter_beat_intervals)
-                       if ibi * factor < mean_IBI or ibi <= 0]
+    anomalous = (inter_beat_intervals * factor < mean_IBI) | (inter_beat_intervals <= 0)
+    anomaly_indices = [(i, i+1) for i in np.flatnonzero(anomalous).tolist()]
     if verbose:
         [print(f"Anomaly between beats {i} and {j} detected: {beats[j]-beats[i]}s (min. {factor*mean_IBI}s)")
          for i, j in anomaly_indices]
@@ -130,22 +144,28 @@ task_docs = {
 }
 
 param_sources = (get_beats, find_outliers)
+sweep_params = ("max_tries", "factor")
 
 
 def gen_tasks(piece_id: str, targets, **kwargs):
     """Generate beat-related tasks."""
-    yield from gen_task_beats(piece_id, targets, **kwargs)
-    yield from gen_task_bars(piece_id, targets, **kwargs)
-    yield from gen_task_tempo(piece_id, targets)
+    # The alignment is shared by all values of swept parameters
+    for suffix, sweep_kwargs in expand_sweep(kwargs, sweep_params):
+        yield from gen_task_beats(piece_id, targets, suffix, **sweep_kwargs)
+        yield from gen_task_bars(piece_id, targets, suffix, **sweep_kwargs)
+        yield from gen_task_tempo(piece_id, targets, suffix)
 
 
-def gen_task_beats(piece_id: str, targets, **kwargs):
+def gen_task_beats(piece_id: str, targets, suffix: str = "", **kwargs):
     """Generate tasks for bars."""
     # Attempt using manual annotations
-    perf_beats = targets("beats")
-    ref_midi = targets("ref_midi")
+    perf_beats = add_suffix(targets("beats"), suffix)
+    ref_score = targets("ref_score")
     perf_match = targets("match")
     if targets("manual_beats") is not None:
+        if suffix:  # Manual annotations are not affected by parameters
+            return
+
         def manual_caller(manual_beats, perf_beats):
             beats = read_beats(manual_beats)
             if find_outliers(beats, factor=10, verbose=True) != []:
@@ -164,29 +184,33 @@ def gen_task_beats(piece_id: str, targets, **kwargs):
         if(targets("score") is None or targets("perfmidi") is None):
             return
 
-        def caller(perf_match, ref_midi, perf_beats):
+        def caller(perf_match, ref_score, perf_beats, **kwargs):
             alignment = get_alignment.read_alignment(perf_match)
-            beat_reference = get_beat_reference_pm(ref_midi)
-            beats, _ = get_beats(alignment, beat_reference)
+            beat_reference = get_beat_reference_pm(ref_score)
+            beats, _ = get_beats(alignment, beat_reference, **kwargs)
             beats.to_csv(perf_beats, index_label="count")
             return True
         yield {
             'basename': "beats",
-            'file_dep': [perf_match, ref_midi, __file__],
-            'name': piece_id,
+            'file_dep': [perf_match, ref_score, __file__],
+            'name': piece_id + suffix,
             'doc': task_docs["beats"],
             'targets': [perf_beats],
-            'actions': [(caller, [perf_match, ref_midi, perf_beats])]
+            'uptodate': [config_changed(kwargs)],
+            'actions': [(caller, [perf_match, ref_score, perf_beats], kwargs)]
         }
 
 
-def gen_task_bars(piece_id: str, targets, **kwargs):
+def gen_task_bars(piece_id: str, targets, suffix: str = "", **kwargs):
     """Generate tasks for bars."""
-    perf_bars = targets("bars")
-    ref_midi = targets("ref_midi")
+    perf_bars = add_suffix(targets("bars"), suffix)
+    ref_score = targets("ref_score")
     perf_match = targets("match")
 
     if targets("manual_bars") is not None:
+        if suffix:  # Manual annotations are not affected by parameters
+            return
+
         def manual_caller_bar(manual_beats, perf_beats):
             beats = read_beats(manual_beats)
             if find_outliers(beats, factor=10, verbose=True) != []:
@@ -202,29 +226,32 @@ def gen_task_bars(piece_id: str, targets, **kwargs):
             'actions': [(manual_caller_bar, [targets("manual_bars"), perf_bars])]
         }
     elif not (targets("score") is None or targets("perfmidi") is None):
-        def caller_bar(perf_match, ref_midi, perf_bars):
+        def caller_bar(perf_match, ref_score, perf_bars, **kwargs):
             alignment = get_alignment.read_alignment(perf_match)
-            bar_reference = get_bar_reference_pm(ref_midi)
-            bars, _ = get_beats(alignment, bar_reference)
+            bar_reference = get_bar_reference_pm(ref_score)
+            bars, _ = get_beats(alignment, bar_reference, **kwargs)
             bars.to_csv(perf_bars, index_label="count")
             return True
         yield {
             'basename': "bars",
-            'file_dep': [perf_match, ref_midi, __file__],
-            'name': piece_id,
+            'file_dep': [perf_match, ref_score, __file__],
+            'name': piece_id + suffix,
             'doc': task_docs["bars"],
             'targets': [perf_bars],
-            'actions': [(caller_bar, [perf_match, ref_midi, perf_bars])]
+            'uptodate': [config_changed(kwargs)],
+            'actions': [(caller_bar, [perf_match, ref_score, perf_bars], kwargs)]
         }
 
 
-def gen_task_tempo(piece_id: str, targets):
+def gen_task_tempo(piece_id: str, targets, suffix: str = ""):
     """Generate tempo tasks."""
     # Attempt using manual annotations
-    perf_beats = targets("beats")
+    if suffix and targets("manual_beats") is not None:
+        return
+    perf_beats = add_suffix(targets("beats"), suffix)
 
     if not (targets("score") is None or targets("perfmidi") is None) or targets("manual_beats") is not None:
-        perf_tempo = targets("tempo")
+        perf_tempo = add_suffix(targets("tempo"), suffix)
 
         def caller(perf_beats, perf_tempo):
             data = pd.read_csv(perf_beats)
@@ -234,7 +261,7 @@ def gen_task_tempo(piece_id: str, targets):
         yield {
             'basename': "tempo",
             'file_dep': [perf_beats, __file__],
-            'name': piece_id,
+            'name': piece_id + suffix,
             'doc': task_docs["tempo"],
             'targets': [perf_tempo],
             'actions': [(caller, [perf_beats, perf_tempo])]
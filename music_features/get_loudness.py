@@ -1,6 +1,12 @@
 """Module wrapping a port of MA toolbox's loudness computation."""
+import collections
+import concurrent.futures
+import itertools
 import os
-from typing import Iterable, List, Optional
+import threading
+from time import perf_counter
+from typing import Iterable, List, NamedTuple, Optional
+import warnings
 
 from doit.tools import config_changed
 import lowess
@@ -13,35 +19,98 @@ import scipy.signal
 import soundfile as sf
 
 from . import _ma_sone
+from .util import add_suffix
+from .util import expand_sweep
 
 
-def get_loudness(input_path: str, *, export_loudness: bool = True, export_dir: Optional[str] = None, **kwargs):
+def get_loudness(input_path: str, *, export_loudness: bool = True, export_dir: Optional[str] = None,
+                 columns: str = 'all', workers: Optional[int] = 1, ordered: bool = True, keep_data: bool = True,
+                 **kwargs):
     """
     Compute Global Loudness of Audio Files.
 
     input_path    : string; folder path or wav audio file path
     exportLoudness: boolean; export as csv (true by default)
     export_dir    : string; folder in which to save the export (default: same as input)
+    columns       : string; which column - 'all' (default), 'raw', 'norm', 'smooth', 'envelope'
+    workers       : int; number of processes for batch runs (1 by default, None for one per core)
+    ordered       : boolean; process (and export) results in input order rather than as they complete
+    keep_data     : boolean; keep the computed tables in memory (true by default). If false, each table
+                    is only exported as soon as it is computed and the export path is returned instead
     smoothSpan    : double; number of data points for calculating the smooth curve (0.03 by default)
     no_negative   : boolean; set L(i) < 0 = 0 (true by default)
-    columns       : string; which column - 'all' (default), 'raw', 'norm', 'smooth', 'envelope'
 
-    returns       :  array; Time (:,1) Loudness (:,2), Scaled (:,3), Scaled-smoothed (:,4), Scaled-envelope (:,5)
+    returns       :  list of arrays, in input order; Time (:,1) Loudness (:,2), Scaled (:,3), Scaled-smoothed (:,4),
+                     Scaled-envelope (:,5). In batch runs, files for which the computation failed are None
+                     (with a warning); for a single file, the error is raised.
     """
     # Dispatch between single or batch run based on path type
+    is_batch = os.path.isdir(input_path)
     if os.path.isfile(input_path):  # Single run
         files_list = [input_path]
-    elif os.path.isdir(input_path):  # Batch run
-        files_list = [f for f in os.listdir(input_path) if f.endswith('.wav') and not f.startswith('._')]
+    elif is_batch:  # Batch run
+        files_list = [os.path.join(input_path, f) for f in sorted(os.listdir(input_path))
+                      if f.endswith('.wav') and not f.startswith('._')]
     else:
         raise ValueError(f"Invalid path: {input_path}")
 
-    loudness_all = [compute_loudness(audio_file, export_dir=export_dir, **kwargs) for audio_file in files_list]
-    if export_loudness:
-        export_dir = export_dir or os.path.dirname(input_path)
-        for loud, infile in zip(loudness_all, files_list):
-            write_loudness(loud, audio_path=infile, export_dir=export_dir, **kwargs)
-    return loudness_all
+    loudness_all = {}
+    for audio_file, loudness in iter_loudness(files_list, workers=workers, ordered=ordered, **kwargs):
+        if isinstance(loudness, Exception):
+            if not is_batch:  # Errors are only isolated between the files of a batch
+                raise loudness
+            warnings.warn(f"Failed to compute loudness for {audio_file}: {loudness!r}")
+            loudness_all[audio_file] = None
+            continue
+        if export_loudness:
+            export_path = os.path.join(export_dir or os.path.dirname(audio_file),
+                                       os.path.basename(audio_file).replace(".wav", "_loudness.csv"))
+            write_loudness(loudness, columns=columns, export_path=export_path)
+        loudness_all[audio_file] = loudness if keep_data else (export_path if export_loudness else None)
+    return [loudness_all[audio_file] for audio_file in files_list]
+
+
+def iter_loudness(files_list: List[str], *, workers: Optional[int] = 1, ordered: bool = True, **kwargs):
+    """Compute the loudness of several files, possibly in parallel processes.
+
+    Yields (audio_path, loudness) pairs, in input order if ordered or as they complete otherwise.
+    An exception raised by one file is yielded in place of its loudness instead of interrupting the batch.
+    Only a few files are submitted ahead of the one being yielded, so finished results do not pile up in memory.
+    """
+    if workers == 1:
+        for audio_file in files_list:
+            try:
+                yield audio_file, compute_loudness(audio_file, **kwargs)
+            except Exception as e:
+                yield audio_file, e
+        return
+
+    # Bound the submitted files so that only a few results wait to be yielded at any time
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    files = iter(files_list)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.OrderedDict()  # Future -> audio_file, in submission order
+        for audio_file in files:
+            pending[executor.submit(compute_loudness, audio_file, **kwargs)] = audio_file
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            if ordered:
+                future = next(iter(pending))
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = next(iter(done))
+            # Release the future (and its result) once it has been yielded
+            audio_file = pending.pop(future)
+            try:
+                loudness = future.result()
+            except Exception as e:
+                loudness = e
+            del future
+            for next_file in itertools.islice(files, 1):
+                pending[executor.submit(compute_loudness, next_file, **kwargs)] = next_file
+            yield audio_file, loudness
+            del loudness
 
 
 def clip_negative(x_array: Iterable[float]) -> List[float]:
@@ -49,11 +118,21 @@ def clip_negative(x_array: Iterable[float]) -> List[float]:
     return [0 if x < 0 else x for x in x_array]
 
 
-def compute_loudness(audio_path, *, smooth_span=0.03, no_negative=True, **kwargs):
-    """Compute the raw loudness and its post-processed versions."""
-    time, raw_loudness = compute_raw_loudness(audio_path, **kwargs)
+def compute_loudness(audio_path, bands_path=None, *, smooth_span=0.03, smooth_backend='lowess', no_negative=True,
+                     **kwargs):
+    """Compute the raw loudness and its post-processed versions.
+
+    If bands_path is given, the loudness of each critical band is also written there (see read_loudness_bands).
+    """
+    time, raw_loudness = compute_raw_loudness(audio_path, bands_path, **kwargs)
+    return postprocess_loudness(time, raw_loudness, smooth_span=smooth_span, smooth_backend=smooth_backend,
+                                no_negative=no_negative)
+
+
+def postprocess_loudness(time, raw_loudness, *, smooth_span=0.03, smooth_backend='lowess', no_negative=True):
+    """Compute the post-processed versions of the raw loudness (normalized, smoothed and envelope)."""
     norm_loudness = rescale(raw_loudness)
-    smooth_loudness = smooth(norm_loudness, smooth_span)
+    smooth_loudness = smooth(norm_loudness, smooth_span, backend=smooth_backend)
     min_separation = len(time) // time[-1]
     envelope_loudness = peak_envelope(norm_loudness, min_separation)
 
@@ -107,31 +186,147 @@ def plot_loudness(time, raw_loudness, norm_loudness, smooth_loudness, envelope_l
         plt.show()
 
 
-def compute_raw_loudness(audio_path, **kwargs):
-    """Compute the raw loudness using the python port of the MA toolbox."""
+def compute_raw_loudness(audio_path, bands_path=None, *, stream_frames=0, frame_workers=1, **kwargs):
+    """Compute the raw loudness using the python port of the MA toolbox.
+
+    If stream_frames is positive, the audio is read from disk by blocks of that many fft frames,
+    so that memory use does not grow with the length of the recording.
+    If frame_workers is more than 1, the fft frames are split in that many contiguous ranges processed in parallel.
+    If bands_path is given, the loudness of each critical band (sone matrix) is also written there.
+    """
+    if stream_frames > 0 or frame_workers > 1:
+        return compute_raw_loudness_stream(audio_path, stream_frames, bands_path, workers=frame_workers, **kwargs)
     audio, fs = sf.read(audio_path)
     if audio.ndim == 2:
         audio = np.mean(audio, 1)
 
-    _, tmp = _ma_sone.ma_sone(audio, fs=fs, **kwargs)
+    sone, tmp = _ma_sone.ma_sone(audio, fs=fs, **kwargs)
+    if bands_path is not None:
+        write_loudness_bands(bands_path, sone)
     time, raw_loudness = tmp.T  # Unpack by column
     return time, raw_loudness
 
 
+def compute_raw_loudness_stream(audio_path, block_frames, bands_path=None, *, workers=1, fft_size=1024, hop_size=512,
+                                **kwargs):
+    """Compute the raw loudness by streaming the audio from disk by blocks of block_frames fft frames.
+
+    The fft frames are split in workers contiguous ranges, each streamed by its own thread (the fft and array
+    operations release the GIL); a block_frames of 0 reads each range at once.
+    As every fft frame is computed independently, the result is identical to the sequential computation.
+    """
+    info = sf.info(audio_path)
+    overlap = fft_size - hop_size
+    total_frames = max((info.frames - fft_size) // hop_size + 1, 0)
+    if total_frames == 0:  # Shorter than one fft frame: nothing to stream
+        return compute_raw_loudness(audio_path, bands_path, fft_size=fft_size, hop_size=hop_size, **kwargs)
+    bounds = np.linspace(0, total_frames, max(workers, 1) + 1).astype(int)
+    bands = None
+    bands_lock = threading.Lock()
+
+    def process_range(first_frame, end_frame):
+        nonlocal bands
+        blocksize = (block_frames or end_frame-first_frame)*hop_size + overlap
+        blocks = (np.mean(block, 1) if block.ndim == 2 else block
+                  for block in sf.blocks(audio_path, blocksize=blocksize, overlap=overlap,
+                                         start=first_frame*hop_size, stop=(end_frame-1)*hop_size + fft_size))
+        loudness_blocks = []
+        frame_count = first_frame
+        for sone, tot_loudness in _ma_sone.ma_sone_blocks(blocks, info.samplerate, fft_size=fft_size,
+                                                          hop_size=hop_size, first_frame=first_frame, **kwargs):
+            if bands_path is not None:  # Written through a memory map to keep memory bounded
+                with bands_lock:
+                    if bands is None:
+                        bands = np.lib.format.open_memmap(bands_path, mode='w+',
+                                                          shape=(sone.shape[0], total_frames))
+                bands[:, frame_count:frame_count+sone.shape[1]] = sone
+            frame_count += sone.shape[1]
+            loudness_blocks.append(tot_loudness)
+        return loudness_blocks
+
+    ranges = [(first, end) for first, end in zip(bounds[:-1], bounds[1:]) if end > first]
+    if len(ranges) > 1:
+        with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+            range_blocks = list(executor.map(lambda frame_range: process_range(*frame_range), ranges))
+    else:
+        range_blocks = [process_range(*frame_range) for frame_range in ranges]
+    if bands is not None:
+        bands.flush()
+    time, raw_loudness = np.concatenate([block for blocks in range_blocks for block in blocks]).T  # Unpack by column
+    return time, raw_loudness
+
+
+def write_raw_loudness(path, time, raw_loudness):
+    """Write the raw loudness and its time stamps to disk as a .npy file."""
+    np.save(path, np.stack([time, raw_loudness], axis=1))
+
+
+def read_raw_loudness(path):
+    """Read the raw loudness and its time stamps from disk."""
+    time, raw_loudness = np.load(path).T  # Unpack by column
+    return time, raw_loudness
+
+
+def write_loudness_bands(path, sone):
+    """Write the loudness of each critical band (bands x frames sone matrix) to disk as a .npy file."""
+    np.save(path, sone)
+
+
+def read_loudness_bands(path):
+    """Read the loudness of each critical band from disk.
+
+    The matrix is memory-mapped: slices (e.g. bands[3] or bands[:, start:end]) are only read when accessed.
+    Frames (columns) are those of the loudness table.
+    """
+    return np.load(path, mmap_mode='r')
+
+
 def rescale(data):
     """Scale data linearly between 0 and 1."""
     return np.interp(data, (data.min(), data.max()), (0, 1))
 
 
-def smooth(data, span):
-    """Use lowess regression to smooth loudness."""
+def smooth(data, span, backend='lowess'):
+    """Use lowess regression to smooth loudness.
+
+    backend is either 'lowess' (reference implementation from the lowess package)
+    or 'numpy' (vectorized equivalent, much faster on long recordings).
+    """
     if 0 < span < 1:  # span is given as a ratio
         span = np.floor(len(data)*span)
         span += span % 2 - 1
     bandwidth = (span+2)/len(data)
+    if backend == 'numpy':
+        return lowess_quadratic(np.asarray(data, dtype=float), bandwidth)
+    if backend != 'lowess':
+        raise ValueError(f"Unknown smoothing backend: {backend}")
     return lowess.lowess(pd.Series(range(len(data))), pd.Series(data), bandwidth=bandwidth, polynomialDegree=2)
 
 
+def lowess_quadratic(data, bandwidth):
+    """Compute a degree 2 lowess regression of regularly spaced data.
+
+    Same model as the lowess package (tricube weights over the nearest bandwidth*len(data) points), but the
+    weighted sums of the local least squares problems are computed for all points at once by convolution.
+    """
+    n = len(data)
+    half_width = int(np.floor((n * bandwidth - 0.5) / 2.0))
+    if 2*half_width + 1 > n:  # Windows would be truncated on both sides, with varying weights
+        return np.array(lowess.lowess(pd.Series(range(n)), pd.Series(data), bandwidth=bandwidth, polynomialDegree=2))
+    offsets = np.arange(-half_width, half_width+1)
+    weights = (1.0 - (np.abs(offsets) / (1.0001 * half_width)) ** 3) ** 3
+    scaled_offsets = offsets / half_width  # Better conditioned than raw positions
+
+    def window_sums(values, power):
+        return scipy.signal.fftconvolve(values, (weights * scaled_offsets**power)[::-1], mode='same')
+
+    # Normal equations of the weighted fit around each point; its value there is the constant coefficient
+    moments = [window_sums(np.ones(n), power) for power in range(5)]
+    normal_matrices = np.stack([np.stack(moments[i:i+3], axis=-1) for i in range(3)], axis=-2)
+    weighted_data = np.stack([window_sums(data, power) for power in range(3)], axis=-1)
+    return np.linalg.solve(normal_matrices, weighted_data[..., np.newaxis])[:, 0, 0]
+
+
 def peak_envelope(data, min_separation):
     """Find the peak envelope of loudness."""
     peaks_idx, _ = scipy.signal.find_peaks(data, distance=min_separation+1)  # +1 for consistency with matlab
@@ -140,6 +335,97 @@ def peak_envelope(data, min_separation):
     return spline(range(len(data)))
 
 
+class LoudnessFrame(NamedTuple):
+    """Loudness of one frame computed online."""
+
+    time: float  # Time of the start of the frame, in seconds from the start of the stream
+    loudness: float  # Raw loudness (sone)
+    loudness_norm: float  # Loudness rescaled between the running min and max
+    loudness_smooth: float  # Causally smoothed normalized loudness
+    latency: float  # Processing time of the frame, in seconds
+
+
+class OnlineLoudness:
+    """Compute loudness on live audio, frame by frame as the samples arrive.
+
+    Chunks of any size are pushed with push(); a ring buffer holds the last fft_size samples and every hop yields
+    a frame whose raw loudness is identical to the offline computation (compute_raw_loudness).
+    Since the whole signal is not known, normalization uses the running min and max, and smoothing is causal:
+    either 'exponential' (exponential moving average with a span of smooth_frames) or 'window'
+    (mean of the last smooth_frames values).
+    """
+
+    def __init__(self, fs=44100, *, smoothing='exponential', smooth_frames=32, fft_size=1024, hop_size=512,
+                 **kwargs):
+        if smoothing not in ('exponential', 'window'):
+            raise ValueError(f"Unknown smoothing: {smoothing}")
+        self.fs = fs
+        self.fft_size = fft_size
+        self.hop_size = hop_size
+        self.smoothing = smoothing
+        self.smooth_frames = smooth_frames
+        self.sone_kwargs = kwargs
+
+        self._ring = np.zeros(fft_size)
+        self._write_index = 0  # Position of the oldest sample, where the next one is written
+        self._received = 0  # Number of samples received so far
+        self._frame_count = 0
+        self._min = np.inf
+        self._max = -np.inf
+        self._smooth = None
+        self._window = collections.deque(maxlen=smooth_frames)
+
+    def push(self, samples) -> List[LoudnessFrame]:
+        """Add samples (mono or frames x channels) to the stream and return the frames completed by them."""
+        samples = np.asarray(samples, dtype=float)
+        if samples.ndim == 2:
+            samples = np.mean(samples, 1)
+        frames = []
+        position = 0
+        while position < len(samples):
+            next_frame_end = self.fft_size + self._frame_count * self.hop_size
+            count = min(len(samples) - position, next_frame_end - self._received)
+            self._write(samples[position:position+count])
+            position += count
+            self._received += count
+            if self._received == next_frame_end:
+                frames.append(self._process_frame())
+        return frames
+
+    def _write(self, samples):
+        """Write samples in the ring buffer, overwriting the oldest ones."""
+        while len(samples) > 0:
+            count = min(len(samples), self.fft_size - self._write_index)
+            self._ring[self._write_index:self._write_index+count] = samples[:count]
+            self._write_index = (self._write_index + count) % self.fft_size
+            samples = samples[count:]
+
+    def _process_frame(self) -> LoudnessFrame:
+        """Compute the loudness of the frame held in the ring buffer."""
+        start = perf_counter()
+        frame = np.concatenate((self._ring[self._write_index:], self._ring[:self._write_index]))  # Oldest first
+        _, tot_loudness = _ma_sone.ma_sone(frame, fs=self.fs, fft_size=self.fft_size, hop_size=self.hop_size,
+                                           **self.sone_kwargs)
+        loudness = float(tot_loudness[0, 1])
+        frame_time = self._frame_count * (self.hop_size/self.fs)
+        self._frame_count += 1
+
+        # Running normalization
+        self._min = min(self._min, loudness)
+        self._max = max(self._max, loudness)
+        loudness_norm = (loudness - self._min) / (self._max - self._min) if self._max > self._min else 0.0
+
+        # Causal smoothing
+        if self.smoothing == 'exponential':
+            alpha = 2 / (self.smooth_frames + 1)
+            previous = loudness_norm if self._smooth is None else self._smooth
+            self._smooth = previous + alpha*(loudness_norm - previous)
+        else:
+            self._window.append(loudness_norm)
+            self._smooth = sum(self._window) / len(self._window)
+        return LoudnessFrame(frame_time, loudness, loudness_norm, self._smooth, perf_counter() - start)
+
+
 def resample(loud_path, beat_path, out_path):
     """Interpolate the loudness at the position of beats."""
     data = read_loudness(loud_path)
@@ -160,48 +446,91 @@ def read_loudness(path):
 
 
 task_docs = {
-    "loudness": "Compute loudness using a port of the MA matlab toolbox",
+    "loudness_raw": "Compute raw loudness using a port of the MA matlab toolbox",
+    "loudness": "Post-process the raw loudness (normalization, smoothing and envelope)",
+    "loudness_bands": "Compute the loudness of each critical band (memory-mappable .npy, only with export_bands)",
     "loudness_resample": "Resample loudness at the time of the beats"
 }
 
-param_sources = (compute_loudness, _ma_sone.ma_sone)
+# Parameters that only change how the raw loudness is computed, not its value
+execution_params = ('stream_frames', 'frame_workers', 'fft_workers')
 
 
-def gen_tasks(piece_id, targets, **kwargs):
-    """Generate loudness-based tasks."""
+def gen_tasks(piece_id, targets, *, export_bands=False, **kwargs):
+    """Generate loudness-based tasks.
+
+    The loudness of each critical band is large (about 60MB per hour of audio), so it is only written if export_bands.
+    """
     if targets("perfaudio") is None:
         return
 
-    perf_loudness = targets("loudness")
-    perf_loudness_simple = targets("loudness_simple")
+    # Only the cheap post-processing is rerun when its own parameters change
+    postprocess_kwargs = {key: value for key, value in kwargs.items() if key in postprocess_loudness.__kwdefaults__}
+    raw_kwargs = {key: value for key, value in kwargs.items() if key not in postprocess_kwargs}
+    raw_config = {key: value for key, value in raw_kwargs.items() if key not in execution_params}
 
-    def caller(perf_path, perf_loudness, perf_loudness_simple, **kwargs):
-        loudness = compute_loudness(perf_path, **kwargs)
-        write_loudness(loudness, export_path=perf_loudness)
-        write_loudness(loudness, export_path=perf_loudness_simple, columns="smooth")
+    perf_loudness_raw = targets("loudness_raw")
+    perf_loudness_bands = targets("loudness_bands") if export_bands else None
+
+    def caller_raw(perf_path, perf_loudness_raw, perf_loudness_bands, **kwargs):
+        time, raw_loudness = compute_raw_loudness(perf_path, perf_loudness_bands, **kwargs)
+        write_raw_loudness(perf_loudness_raw, time, raw_loudness)
         return True
     yield {
-        'basename': "loudness",
-        'file_dep': [targets("perfaudio"), __file__],
+        'basename': "loudness_raw",
+        'file_dep': [targets("perfaudio"), __file__, _ma_sone.__file__],
         'name': piece_id,
-        'doc': task_docs["loudness"],
-        'targets': [perf_loudness, perf_loudness_simple],
-        'uptodate': [config_changed(kwargs)],
-        'actions': [(caller, [targets("perfaudio"), perf_loudness, perf_loudness_simple])]
+        'doc': task_docs["loudness_raw"],
+        'targets': [perf_loudness_raw] + ([perf_loudness_bands] if export_bands else []),
+        'uptodate': [config_changed(raw_config)],
+        'actions': [(caller_raw, [targets("perfaudio"), perf_loudness_raw, perf_loudness_bands], raw_kwargs)]
     }
+    if export_bands:  # Bands are a by-product of the raw loudness computation
+        yield {
+            'basename': "loudness_bands",
+            'name': piece_id,
+            'doc': task_docs["loudness_bands"],
+            'task_dep': [f"loudness_raw:{piece_id}"],
+            'actions': None
+        }
+
+    def caller(perf_loudness_raw, perf_loudness, perf_loudness_simple, **kwargs):
+        loudness = postprocess_loudness(*read_raw_loudness(perf_loudness_raw), **kwargs)
+        write_loudness(loudness, export_path=perf_loudness)
+        write_loudness(loudness, export_path=perf_loudness_simple, columns="smooth")
+        return True
 
-    if targets("manual_beats") is None and (targets("score") is None or targets("perfmidi") is None):
-        return
-
-    perf_beats = targets("beats")
-
-    perf_resampled_loudness = targets("loudness_resampled")
-    yield {
-        'basename': "loudness_resample",
-        'file_dep': [perf_loudness, perf_beats, __file__],
-        'name': piece_id,
-        'doc': task_docs["loudness_resample"],
-        'targets': [perf_resampled_loudness],
-        'uptodate': [config_changed(kwargs)],
-        'actions': [(resample, [perf_loudness, perf_beats, perf_resampled_loudness])]
-    }
+    has_beats = not (targets("manual_beats") is None and (targets("score") is None or targets("perfmidi") is None))
+    # The raw loudness is shared by all values of swept post-processing parameters
+    for suffix, sweep_kwargs in expand_sweep(postprocess_kwargs, sweep_params):
+        perf_loudness = add_suffix(targets("loudness"), suffix)
+        perf_loudness_simple = add_suffix(targets("loudness_simple"), suffix)
+        yield {
+            'basename': "loudness",
+            'file_dep': [perf_loudness_raw, __file__],
+            'name': piece_id + suffix,
+            'doc': task_docs["loudness"],
+            'targets': [perf_loudness, perf_loudness_simple],
+            'uptodate': [config_changed(sweep_kwargs)],
+            'actions': [(caller, [perf_loudness_raw, perf_loudness, perf_loudness_simple], sweep_kwargs)]
+        }
+
+        if not has_beats:
+            continue
+
+        perf_beats = targets("beats")
+
+        perf_resampled_loudness = add_suffix(targets("loudness_resampled"), suffix)
+        yield {
+            'basename': "loudness_resample",
+            'file_dep': [perf_loudness, perf_beats, __file__],
+            'name': piece_id + suffix,
+            'doc': task_docs["loudness_resample"],
+            'targets': [perf_resampled_loudness],
+            'actions': [(resample, [perf_loudness, perf_beats, perf_resampled_loudness])]
+        }
+
+
+# Listed after gen_tasks, whose export_bands is a task parameter
+param_sources = (postprocess_loudness, compute_raw_loudness, _ma_sone.ma_sone, gen_tasks)
+sweep_params = tuple(postprocess_loudness.__kwdefaults__)
@@ -1,8 +1,25 @@
 """Module to extract midi events in a more convenient format."""
 import argparse
+import collections
+import functools
+import os
+from typing import List, Tuple
 import warnings
 
+from doit.tools import config_changed
 import mido
+import numpy as np
+
+from . import _smf
+
+
+# Tempo (in microseconds per beat) until the first set_tempo event
+default_tempo = 500000
+
+# Columns of the note and control change tables, indexed by their position among all events of the file
+note_dtype = np.dtype([('Index', np.int64), ('StartTime', np.float64), ('EndTime', np.float64),
+                       ('Note', np.int16), ('Velocity', np.int16)])
+control_dtype = np.dtype([('Index', np.int64), ('Time', np.float64), ('Control', np.int16), ('Value', np.int16)])
 
 
 def get_midi_events(perf_filename, verbose=False):
@@ -10,56 +27,214 @@ def get_midi_events(perf_filename, verbose=False):
 
     Only note on and off events and control events are listed
     Meta events are read and optionally logged, but not returned
+    This is a view of the tables of get_midi_event_table, which should be preferred.
     """
-    midi = mido.MidiFile(perf_filename)
+    notes, controls = get_midi_event_table(perf_filename, verbose=verbose)
+    return event_table_to_list(notes, controls)
+
 
-    # Default value for tempo; might be set by a value for set_tempo later
-    tempo = 500000
+def get_midi_event_table(perf_filename, verbose=False, *, backend='mido') -> Tuple[np.ndarray, np.ndarray]:
+    """Get the notes and control changes of a midi file as structured arrays.
+
+    The tables are cached (by path, modification time, size and backend), so a file is only parsed once per process
+    The cached tables are read-only; copy them before modifying them
+    """
+    if verbose:
+        return parse_midi_event_table(perf_filename, verbose=True, backend=backend)
+    stat = os.stat(perf_filename)
+    return _cached_event_table(os.path.abspath(perf_filename), stat.st_mtime_ns, stat.st_size, backend)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_event_table(perf_filename, _mtime, _size, backend):
+    notes, controls = parse_midi_event_table(perf_filename, backend=backend)
+    notes.flags.writeable = False
+    controls.flags.writeable = False
+    return notes, controls
+
+
+def parse_midi_event_table(perf_filename, verbose=False, *, backend='mido') -> Tuple[np.ndarray, np.ndarray]:
+    """Parse the notes and control changes of a midi file into structured arrays.
+
+    Note offs are paired to the earliest unmatched note on of the same pitch (in the same track);
+    notes without a note off have a nan EndTime.
+    Times follow the tempo changes of the file (shared by all tracks, as in type 0 and 1 files).
+    Meta events are read and optionally logged (with the mido backend), but not returned
+
+    Args:
+        perf_filename (str): path to the midi file
+        verbose (bool): whether to print the messages of the file
+        backend (str): 'mido' or 'native' (faster, see _smf)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: notes (with dtype note_dtype) and control changes (with dtype control_dtype)
+    """
+    if backend == 'mido':
+        ppq, tracks, tempo_changes = read_mido_tracks(perf_filename, verbose=verbose)
+    elif backend == 'native':
+        ppq, tracks, tempo_changes = _smf.read_smf(perf_filename)
+    else:
+        raise ValueError(f"Unknown midi backend: {backend}")
 
     # Use default for pulses per quarter note if its not set
-    ppq = midi.ticks_per_beat or 96
+    ppq = ppq or 96
+
+    notes = []
+    controls = []
+    event_count = 0
+    for track in tracks:
+        track_notes, track_controls = pair_track_events(track, ticks_to_seconds(track['Tick'], tempo_changes, ppq))
+        track_notes['Index'] += event_count
+        track_controls['Index'] += event_count
+        event_count += len(track_notes) + len(track_controls)
+        notes.append(track_notes)
+        controls.append(track_controls)
+
+    return (np.concatenate(notes) if notes else np.empty(0, dtype=note_dtype),
+            np.concatenate(controls) if controls else np.empty(0, dtype=control_dtype))
 
-    # For storing the elapsed time for MIDI events in seconds
-    event_list = []
 
+def read_mido_tracks(perf_filename, verbose=False) -> Tuple[int, List[np.ndarray], np.ndarray]:
+    """Read the note, control change and tempo events of a midi file with mido (see _smf.read_smf)."""
+    midi = mido.MidiFile(perf_filename)
+
+    tracks = []
+    tempo_changes = []
     for track in midi.tracks:
-        event_time = 0
-        unmatched_note_on = []
+        events = []
+        tick = 0
         for message in track:
             if verbose:
                 print_message(message)
-            if not message.is_meta:
-                event_time += mido.tick2second(message.time, ppq, tempo)
-                if is_note_off(message):
-                    # Pair the note off to the first matching note on without an end time
-                    try:
-                        match_ = next(event for event in unmatched_note_on if message.note == event['Note'])
-                    except StopIteration:
-                        warnings.warn(f"Found unbalanced note off {message}")
-                    else:
-                        match_['EndTime'] = event_time
-                        unmatched_note_on.remove(match_)
-                elif is_note_on(message):
-                    event_list.append(event := {'StartTime': event_time, 'EndTime': None,
-                                      'Type': message.type, 'Note': message.note, 'Velocity': message.velocity})
-                    unmatched_note_on.append(event)
-                elif message.type == 'control_change':
-                    event_list.append({'Time': event_time, 'Type': message.type,
-                                      'Control': message.control, 'Value': message.value})
-        # Warn if not all note ons have been matched
-        if unmatched_note_on:
-            warnings.warn(f"Found unbalanced note ons: {unmatched_note_on}")
-    return event_list
-
-
-def is_note_on(message):
-    """Test if the message is a (true) note on event."""
-    return message.type == 'note_on' and message.velocity != 0
-
-
-def is_note_off(message):
-    """Test if the message is a note off event."""
-    return message.type == 'note_off' or message.type == 'note_on' and message.velocity == 0
+            tick += message.time
+            if message.type == 'set_tempo':
+                tempo_changes.append((tick, message.tempo))
+            elif message.type in ('note_on', 'note_off', 'control_change'):
+                events.append((tick, message.time, *message.bytes()))
+        tracks.append(np.array(events, dtype=_smf.track_event_dtype))
+
+    tempo_changes = np.array(tempo_changes, dtype=_smf.tempo_change_dtype)
+    return midi.ticks_per_beat, tracks, tempo_changes[np.argsort(tempo_changes['Tick'], kind='stable')]
+
+
+def ticks_to_seconds(ticks, tempo_changes, ppq):
+    """Convert the (sorted) ticks of the events of a track to seconds.
+
+    Args:
+        ticks (np.ndarray): time of each event in ticks since the start of the track
+        tempo_changes (np.ndarray): tempo changes sorted by tick (with dtype _smf.tempo_change_dtype)
+        ppq (int): ticks per beat (quarter note)
+
+    Returns:
+        np.ndarray: time of each event in seconds
+    """
+    # Accumulate the durations between successive events, split at tempo changes
+    steps = np.union1d(np.union1d(ticks, tempo_changes['Tick']), [0])
+    tempos = np.concatenate(([default_tempo], tempo_changes['Tempo']))
+    step_tempos = tempos[np.searchsorted(tempo_changes['Tick'], steps[:-1], side='right')]
+    times = np.concatenate(([0.], np.cumsum(np.diff(steps) * (step_tempos * 1e-6 / ppq))))
+    return times[np.searchsorted(steps, ticks)]
+
+
+def pair_track_events(track, times) -> Tuple[np.ndarray, np.ndarray]:
+    """Build the notes and control changes tables of a track.
+
+    Args:
+        track (np.ndarray): events of the track (with dtype _smf.track_event_dtype)
+        times (np.ndarray): time of each event in seconds
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: notes and control changes, indexed from the start of the track
+    """
+    kinds = track['Status'] >> 4
+    note_ons = (kinds == _smf.NOTE_ON) & (track['Data2'] != 0)
+    note_offs = (kinds == _smf.NOTE_OFF) | (kinds == _smf.NOTE_ON) & (track['Data2'] == 0)
+    control_changes = kinds == _smf.CONTROL_CHANGE
+    indices = np.cumsum(note_ons | control_changes) - 1
+
+    notes = np.empty(np.count_nonzero(note_ons), dtype=note_dtype)
+    notes['Index'] = indices[note_ons]
+    notes['StartTime'] = times[note_ons]
+    notes['EndTime'] = np.nan
+    notes['Note'] = track['Data1'][note_ons]
+    notes['Velocity'] = track['Data2'][note_ons]
+
+    controls = np.empty(np.count_nonzero(control_changes), dtype=control_dtype)
+    controls['Index'] = indices[control_changes]
+    controls['Time'] = times[control_changes]
+    controls['Control'] = track['Data1'][control_changes]
+    controls['Value'] = track['Data2'][control_changes]
+
+    # Pair each note off to the first matching note on without an end time
+    positions = np.flatnonzero(note_ons | note_offs)
+    end_times = notes['EndTime'].tolist()
+    unmatched_note_on = collections.defaultdict(collections.deque)  # Indices in notes of note ons by pitch
+    note_number = 0
+    for position, pitch, is_note_on, time in zip(positions.tolist(), track['Data1'][positions].tolist(),
+                                                 note_ons[positions].tolist(), times[positions].tolist()):
+        if is_note_on:
+            unmatched_note_on[pitch].append(note_number)
+            note_number += 1
+        elif unmatched_note_on[pitch]:
+            end_times[unmatched_note_on[pitch].popleft()] = time
+        else:
+            warnings.warn(f"Found unbalanced note off {describe_note_off(track[position])}")
+    notes['EndTime'] = end_times
+    # Warn if not all note ons have been matched
+    unmatched = sorted(index for indices in unmatched_note_on.values() for index in indices)
+    if unmatched:
+        warnings.warn(f"Found unbalanced note ons: {[note_to_dict(notes[index]) for index in unmatched]}")
+    return notes, controls
+
+
+def describe_note_off(event):
+    """Describe a note off event of a track table as mido would."""
+    _tick, delta, status, note, velocity = event.tolist()
+    kind = 'note_on' if status >> 4 == _smf.NOTE_ON else 'note_off'
+    return f"{kind} channel={status & 0xF} note={note} velocity={velocity} time={delta}"
+
+
+def read_event_table(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the notes and control changes tables of a midi file from disk.
+
+    Args:
+        path (str): path to an event table written by write_event_table
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: notes and control changes, as returned by get_midi_event_table
+    """
+    with np.load(path) as tables:
+        return tables['notes'], tables['controls']
+
+
+def write_event_table(path: str, notes: np.ndarray, controls: np.ndarray) -> None:
+    """Write the notes and control changes tables of a midi file to disk (as a compressed .npz).
+
+    Args:
+        path (str): path to output file
+        notes (np.ndarray): notes table
+        controls (np.ndarray): control changes table
+    """
+    with open(path, 'wb') as output_file:
+        np.savez_compressed(output_file, notes=notes, controls=controls)
+
+
+def event_table_to_list(notes, controls):
+    """Convert the tables of get_midi_event_table to the list of events of get_midi_events."""
+    events = [None] * (len(notes) + len(controls))
+    for note in notes:
+        events[note['Index']] = note_to_dict(note)
+    for control in controls:
+        events[control['Index']] = {'Time': float(control['Time']), 'Type': 'control_change',
+                                    'Control': int(control['Control']), 'Value': int(control['Value'])}
+    return events
+
+
+def note_to_dict(note):
+    """Convert a row of a note table to an event dictionary, with a None EndTime for unmatched notes."""
+    _index, start_time, end_time, pitch, velocity = note
+    return {'StartTime': float(start_time), 'EndTime': None if np.isnan(end_time) else float(end_time),
+            'Type': 'note_on', 'Note': int(pitch), 'Velocity': int(velocity)}
 
 
 def print_message(message):
@@ -79,6 +254,34 @@ def print_message(message):
         print(message)
 
 
+task_docs = {
+    "midi_events": "Extract the notes and control changes of a midi file"
+}
+
+
+param_sources = (get_midi_event_table,)
+
+
+def gen_tasks(piece_id: str, targets, **kwargs):
+    """Generate midi event extraction tasks."""
+    if targets("perfmidi") is None:
+        return
+    perf_events = targets("midi_events")
+
+    def caller(perf_path, perf_events, **kwargs):
+        write_event_table(perf_events, *get_midi_event_table(perf_path, **kwargs))
+        return None
+    yield {
+        'basename': 'midi_events',
+        'name': piece_id,
+        'doc': task_docs["midi_events"],
+        'file_dep': [targets("perfmidi"), __file__, _smf.__file__],
+        'targets': [perf_events],
+        'uptodate': [config_changed(kwargs)],
+        'actions': [(caller, [targets("perfmidi"), perf_events], kwargs)]
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--perf')
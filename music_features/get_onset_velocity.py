@@ -5,20 +5,18 @@ import warnings
 
 import pandas as pd
 
-from music_features.get_midi_events import get_midi_events
+from music_features.get_midi_events import get_midi_event_table, read_event_table
 
 def get_onset_velocity(perfFilename):
     """Extract onset velocities from a midi file."""
-    velocities = pd.DataFrame([(event['StartTime'], event['Velocity'])
-                               for event in get_midi_events(perfFilename)
-                               if is_note_event(event)],
-                              columns=('Time', 'Velocity'))
-    return velocities
+    notes, _ = get_midi_event_table(perfFilename)
+    return velocities_from_notes(notes)
 
 
-def is_note_event(event):
-    """Test whether the passed event is a note."""
-    return event['Type'] == 'note_on'
+def velocities_from_notes(notes):
+    """Extract onset velocities from a table of notes (see get_midi_event_table)."""
+    velocities = pd.DataFrame({'Time': notes['StartTime'], 'Velocity': notes['Velocity'].astype(int)})
+    return velocities
 
 
 task_docs = {
@@ -30,12 +28,14 @@ def gen_tasks(piece_id, targets):
     """Generate velocity-related tasks."""
     if targets("perfmidi") is None:
         return
+    perf_events = targets("midi_events")
     perf_velocity = targets("velocity")
 
-    def runner(perf_filename, perf_velocity):
-        velocities = get_onset_velocity(targets("perfmidi"))
+    def runner(perf_events, perf_velocity):
+        notes, _ = read_event_table(perf_events)
+        velocities = velocities_from_notes(notes)
         if velocities.size == 0:
-            warnings.warn("Warning: no note on event detected in " + perf_filename)
+            warnings.warn("Warning: no note on event detected in " + targets("perfmidi"))
         else:
             velocities.to_csv(perf_velocity, index=False)
         return None
@@ -43,9 +43,9 @@ def gen_tasks(piece_id, targets):
         'basename': 'velocities',
         'name': piece_id,
         'doc': task_docs["velocities"],
-        'file_dep': [targets("perfmidi"), __file__],
+        'file_dep': [perf_events, __file__],
         'targets': [perf_velocity],
-        'actions': [(runner, [targets("perfmidi"), perf_velocity])]
+        'actions': [(runner, [perf_events, perf_velocity])]
     }
 
 
@@ -0,0 +1,179 @@
+"""Module to extract what is needed from the reference midi of a score once for all features."""
+import functools
+import os
+from typing import NamedTuple, Tuple
+import warnings
+
+import numpy as np
+import pretty_midi as pm
+
+
+instrument_dtype = np.dtype([('Program', np.int16), ('IsDrum', np.bool_)])
+# Notes, control changes and pitch bends refer to their instrument by its index
+note_dtype = np.dtype([('Instrument', np.int16), ('Start', np.float64), ('End', np.float64),
+                       ('Pitch', np.int16), ('Velocity', np.int16)])
+control_dtype = np.dtype([('Instrument', np.int16), ('Time', np.float64), ('Number', np.int16), ('Value', np.int16)])
+pitch_bend_dtype = np.dtype([('Instrument', np.int16), ('Time', np.float64), ('Pitch', np.int16)])
+time_signature_dtype = np.dtype([('Time', np.float64), ('Numerator', np.int16), ('Denominator', np.int16)])
+
+
+class ReferenceScore(NamedTuple):
+    """Beats, bars and notes of a reference midi, according to pretty-midi (times in seconds).
+
+    meta_end_time is the time of the last event outside of instruments (as a 0-d array), which bounds the beats
+    of the score with any subset of its instruments (see beats_until).
+    """
+
+    beats: np.ndarray
+    downbeats: np.ndarray
+    time_signatures: np.ndarray
+    meta_end_time: np.ndarray
+    instruments: np.ndarray
+    notes: np.ndarray
+    control_changes: np.ndarray
+    pitch_bends: np.ndarray
+
+
+def get_reference(ref_filename: str) -> ReferenceScore:
+    """Get the reference of a score from its reference midi or from a reference file written by write_reference.
+
+    References are cached (by path, modification time and size), so a file is only read once per process
+    The arrays of cached references are read-only
+    """
+    stat = os.stat(ref_filename)
+    return _cached_reference(os.path.abspath(ref_filename), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_reference(ref_filename, _mtime, _size):
+    if os.path.splitext(ref_filename)[1] == '.npz':
+        reference = read_reference(ref_filename)
+    else:
+        reference = extract_reference(ref_filename)
+    for array in reference:
+        array.flags.writeable = False
+    return reference
+
+
+def extract_reference(ref_filename: str) -> ReferenceScore:
+    """Extract the beats, bars and notes of a reference midi with pretty-midi."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        pretty = pm.PrettyMIDI(ref_filename)
+    return ReferenceScore(
+        beats=np.array(pretty.get_beats()),
+        downbeats=np.array(pretty.get_downbeats()),
+        time_signatures=np.array([(signature.time, signature.numerator, signature.denominator)
+                                  for signature in pretty.time_signature_changes], dtype=time_signature_dtype),
+        meta_end_time=np.array(max([event.time for events in (pretty.time_signature_changes,
+                                                              pretty.key_signature_changes,
+                                                              pretty.lyrics, pretty.text_events)
+                                    for event in events] + pretty.get_tempo_changes()[0].tolist())),
+        instruments=np.array([(instrument.program, instrument.is_drum) for instrument in pretty.instruments],
+                             dtype=instrument_dtype),
+        notes=np.array([(index, note.start, note.end, note.pitch, note.velocity)
+                        for index, instrument in enumerate(pretty.instruments) for note in instrument.notes],
+                       dtype=note_dtype),
+        control_changes=np.array([(index, control.time, control.number, control.value)
+                                  for index, instrument in enumerate(pretty.instruments)
+                                  for control in instrument.control_changes], dtype=control_dtype),
+        pitch_bends=np.array([(index, bend.time, bend.pitch)
+                              for index, instrument in enumerate(pretty.instruments)
+                              for bend in instrument.pitch_bends], dtype=pitch_bend_dtype)
+    )
+
+
+def read_reference(path: str) -> ReferenceScore:
+    """Read a reference from disk.
+
+    Args:
+        path (str): path to a reference written by write_reference
+
+    Returns:
+        ReferenceScore: the reference
+    """
+    with np.load(path) as reference:
+        return ReferenceScore(**{field: reference[field] for field in ReferenceScore._fields})
+
+
+def write_reference(path: str, reference: ReferenceScore) -> None:
+    """Write a reference to disk (as a compressed .npz).
+
+    Args:
+        path (str): path to output file
+        reference (ReferenceScore): reference to write
+    """
+    with open(path, 'wb') as output_file:
+        np.savez_compressed(output_file, **reference._asdict())
+
+
+def beats_until(reference: ReferenceScore, end_time: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the beats and downbeats that pretty-midi would find if the score ended at end_time.
+
+    pretty-midi places beats until the end of the last event, so that the beats of a score depend on which of its
+    instruments are kept; this gives them for the end time of the kept instruments without parsing the midi again.
+    """
+    beats = reference.beats[reference.beats < max(end_time, reference.meta_end_time)]
+    return beats, downbeats_from_beats(beats, reference.time_signatures)
+
+
+def downbeats_from_beats(beats: np.ndarray, time_signatures: np.ndarray) -> np.ndarray:
+    """Select the downbeats among beats according to the time signatures, as pretty_midi.get_downbeats does."""
+    # If there are no time signatures or they start after 0s, add a 4/4 signature at time 0
+    if len(time_signatures) == 0 or time_signatures['Time'][0] > 0:
+        time_signatures = np.concatenate((np.array([(0., 4, 4)], dtype=time_signature_dtype), time_signatures))
+
+    def index(value, default):
+        """Find the first beat at value, or default if there is none."""
+        indices = np.flatnonzero(np.isclose(beats, value))
+        return indices[0] if indices.size > 0 else default
+
+    downbeats = []
+    end_beat_index = 0
+    for (start_time, numerator, _), end in zip(time_signatures.tolist(), [*time_signatures['Time'][1:], None]):
+        start_beat_index = index(start_time, 0 if end is not None else end_beat_index)
+        end_beat_index = index(end, start_beat_index) if end is not None else None
+        step = numerator // 3 if numerator % 3 == 0 and numerator != 3 else numerator
+        downbeats.append(beats[start_beat_index:end_beat_index:step])
+    return np.concatenate(downbeats)
+
+
+def to_pretty_midi(reference: ReferenceScore) -> pm.PrettyMIDI:
+    """Rebuild the instruments of a reference as a PrettyMIDI object (without its tempo and timing information)."""
+    pretty = pm.PrettyMIDI()
+    for index, (program, is_drum) in enumerate(reference.instruments.tolist()):
+        instrument = pm.Instrument(program, is_drum)
+        instrument.notes = [pm.Note(velocity, pitch, start, end) for _, start, end, pitch, velocity
+                            in reference.notes[reference.notes['Instrument'] == index].tolist()]
+        instrument.control_changes = [pm.ControlChange(number, value, time) for _, time, number, value
+                                      in reference.control_changes[reference.control_changes['Instrument'] == index]
+                                      .tolist()]
+        instrument.pitch_bends = [pm.PitchBend(pitch, time) for _, time, pitch
+                                  in reference.pitch_bends[reference.pitch_bends['Instrument'] == index].tolist()]
+        pretty.instruments.append(instrument)
+    return pretty
+
+
+task_docs = {
+    "reference": "Extract the beats, bars and notes of the reference midi of a score"
+}
+
+
+def gen_tasks(piece_id: str, targets, **kwargs):
+    """Generate reference extraction tasks."""
+    if targets("score") is None:
+        return
+    ref_midi = targets("ref_midi")
+    ref_score = targets("ref_score")
+
+    def caller(ref_midi, ref_score):
+        write_reference(ref_score, extract_reference(ref_midi))
+        return None
+    yield {
+        'basename': 'reference',
+        'name': piece_id,
+        'doc': task_docs["reference"],
+        'file_dep': [ref_midi, __file__],
+        'targets': [ref_score],
+        'actions': [(caller, [ref_midi, ref_score])]
+    }
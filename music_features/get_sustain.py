@@ -1,22 +1,22 @@
 """Module for extracting sustain out of a midi file."""
 import pandas as pd
 
-from .get_midi_events import get_midi_events
+from .get_midi_events import get_midi_event_table, read_event_table
 
 
 def get_sustain(perf_path, *, binary=False):
     """Extract sustain pedal information from a midi file."""
-    sustain = pd.DataFrame([(event['Time'], (event['Value'] >= 64 if binary else event['Value']))
-                            for event in get_midi_events(perf_path)
-                            if is_sustain_event(event)],
-                           columns=('Time', 'Sustain'))
-    return sustain
+    _, controls = get_midi_event_table(perf_path)
+    return sustain_from_controls(controls, binary=binary)
 
 
-def is_sustain_event(event):
-    """Test whether the passed event is a sustain pedal event."""
+def sustain_from_controls(controls, *, binary=False):
+    """Extract sustain pedal information from a table of control changes (see get_midi_event_table)."""
     # 64 is the Midi code for the sustain pedal
-    return event['Type'] == 'control_change' and event['Control'] == 64
+    pedal = controls[controls['Control'] == 64]
+    sustain = pd.DataFrame({'Time': pedal['Time'],
+                            'Sustain': pedal['Value'] >= 64 if binary else pedal['Value'].astype(int)})
+    return sustain
 
 
 def read_sustain(filepath: str) -> pd.DataFrame:
@@ -50,17 +50,19 @@ def gen_tasks(piece_id: str, targets, **kwargs):
     """Generate sustain-related tasks."""
     if targets("perfmidi") is None:
         return
+    perf_events = targets("midi_events")
     perf_sustain = targets("sustain")
 
-    def caller(perf_path, perf_sustain):
-        sustain = get_sustain(perf_path)
+    def caller(perf_events, perf_sustain):
+        _, controls = read_event_table(perf_events)
+        sustain = sustain_from_controls(controls)
         sustain.to_csv(perf_sustain, index=False)
         return None
     yield {
         'basename': 'sustain',
         'name': piece_id,
         'doc': task_docs["sustain"],
-        'file_dep': [targets("perfmidi"), __file__],
+        'file_dep': [perf_events, __file__],
         'targets': [perf_sustain],
-        'actions': [(caller, [targets("perfmidi"), perf_sustain])]
+        'actions': [(caller, [perf_events, perf_sustain])]
     }
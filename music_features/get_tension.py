@@ -1,12 +1,15 @@
 """Wrapping module for Midi-miner's spiral array tension functions."""
 from importlib import resources
 import os
+from typing import Dict, Tuple
 
 from doit.tools import config_changed
 import numpy as np
 import pandas as pd
 
 from . import _tension_calculation as tc
+from .util import add_suffix
+from .util import expand_sweep
 from .util import read_json
 from .util import set_json_file
 from .util import write_json
@@ -24,6 +27,11 @@ def read_tension(input_path) -> pd.DataFrame:
     return pd.read_csv(input_path, usecols=["time", "momentum", "diameter", "strain", "d_diameter", "d_strain"])
 
 
+def read_score_tension(input_path) -> pd.DataFrame:
+    """Read a score tension file (with score times) from disk, without loss of precision."""
+    return pd.read_csv(input_path, float_precision='round_trip')
+
+
 def write_tension(output_path: str, tension: pd.DataFrame):
     """Write a tension dataframe to disk.
 
@@ -50,35 +58,89 @@ def write_tension_json(tension_file: str, json_file: str) -> None:
     return
 
 
-def get_tension(midi_path: str, *, track_num: int = 3, **kwargs):
+def get_tension(midi_path: str, *, track_num: int = 3, window_size: int = 1, beat_division: int = 4,
+                resolution: str = 'grid', **kwargs):
     """Compute Harmonic Tension using midi-miner.
 
     Args:
         midi_path (str): Path to the midi file
         track_num (int): Maximum number of tracks to use
+        window_size (int): Number of beats per tension window (-1 for bars)
+        beat_division (int): Number of time steps per beat (lower is faster but coarser)
+        resolution (str): 'grid' to analyse the notes on time steps of a beat_division grid,
+            or 'events' to analyse them between note on/off events and weight them by duration
 
     Returns:
         pd.Dataframe: dataframe of the harmonic tension
     """
-    pm, piano_roll, beat_data = tc.extract_notes(midi_path, track_num=track_num)
+    notes = tc.extract_notes(midi_path, track_num=track_num, beat_division=beat_division, resolution=resolution)
+    return tension_from_notes(notes, window_size=window_size, resolution=resolution, **kwargs)
+
 
-    (time, strain, diameter, momentum, _key_name,
-     _key_change_info) = tc.cal_tension(pm, piano_roll, beat_data, **kwargs)
+def get_beat_and_bar_tension(midi_path: str, *, track_num: int = 3, window_size: int = 1, beat_division: int = 4,
+                             **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Compute Harmonic Tension at the beat and bar levels from a single analysis of the score.
+
+    Args:
+        midi_path (str): Path to the midi file
+        track_num (int): Maximum number of tracks to use
+        window_size (int): Number of beats per tension window for the beat level
+        beat_division (int): Number of time steps per beat (lower is faster but coarser)
 
-    tension = pd.DataFrame.from_dict({'time': time, 'momentum': momentum,
-                                     'diameter': diameter, 'strain': strain}).rename_axis('beat')
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: dataframes of the beat level and bar level harmonic tension
+    """
+    notes = tc.extract_notes(midi_path, track_num=track_num, beat_division=beat_division,
+                             resolution=kwargs.get('resolution', 'grid'))
+    tensions = tensions_from_notes(notes, (window_size, -1), **kwargs)
+    return tensions[window_size], tensions[-1]
 
-    tension['d_diameter'] = [np.nan, *np.diff(tension['diameter'])]
-    tension['d_strain'] = [np.nan, *np.diff(tension['strain'])]
-    return tension
+
+def tension_from_notes(notes, window_size=1, **kwargs) -> pd.DataFrame:
+    """Compute Harmonic Tension from notes already extracted by tc.extract_notes.
+
+    This allows several tension computations (e.g. with different window sizes) to share the extraction.
+    """
+    return tensions_from_notes(notes, (window_size,), **kwargs)[window_size]
+
+
+def tensions_from_notes(notes, window_sizes, resolution='grid', **kwargs) -> Dict[int, pd.DataFrame]:
+    """Compute Harmonic Tension for several window sizes from notes already extracted by tc.extract_notes.
+
+    Everything but the final windowing is shared between window sizes.
+    """
+    pm, piano_roll, beat_data = notes
+    if resolution == 'events':
+        window_tensions = tc.cal_tension_events(pm, beat_data, window_sizes, **kwargs)
+    elif resolution == 'grid':
+        window_tensions = tc.cal_tension_windows(pm, piano_roll, beat_data, window_sizes, **kwargs)
+    else:
+        raise ValueError(f"Unknown tension resolution: {resolution} (expected 'grid' or 'events')")
+    tensions = {}
+    for window_size, (time, strain, diameter, momentum, _key_name, _key_change_info) in window_tensions.items():
+        tension = pd.DataFrame.from_dict({'time': time, 'momentum': momentum,
+                                         'diameter': diameter, 'strain': strain}).rename_axis('beat')
+
+        tension['d_diameter'] = [np.nan, *np.diff(tension['diameter'])]
+        tension['d_strain'] = [np.nan, *np.diff(tension['strain'])]
+        tensions[window_size] = tension
+    return tensions
+
+
+def window_times(beats: pd.DataFrame, window_size: int) -> pd.Series:
+    """Find the performance time of tension windows from the beat (or bar) times."""
+    windows = beats['time'].iloc[::max(window_size, 1)].reset_index(drop=True)
+    return windows.tail(-1)  # Drop the first beat as tension is not computed there
 
 
 task_docs = {
     "tension": "Compute the tension parameters using midi-miner",
-    "tension_bar": "Compute the tension parameters at the bar level"
+    "tension_bar": "Compute the tension parameters at the bar level",
+    "tension_score": "Compute the beat and bar level tension of the score (before mapping to performance time)"
 }
 
 param_sources = (get_tension, tc.cal_tension)
+sweep_params = ("window_size",)
 
 
 def gen_tasks(piece_id, targets, **kwargs):
@@ -86,46 +148,76 @@ def gen_tasks(piece_id, targets, **kwargs):
     if targets("score") is None:
         return
 
-    ref_midi = targets("ref_midi")
+    ref_score = targets("ref_score")
     perf_beats = targets("beats")
     perf_bars = targets("bars")
-    perf_tension = targets("tension")
     perf_tension_bar = targets("tension_bar")
-    perf_tension_json = targets("tension_json")
     perf_tension_bar_json = targets("tension_bar_json")
+    score_tension_bar = targets("tension_bar_score")
 
-    def caller(perf_tension, perf_tension_json, ref_midi, perf_beats, kwargs_inner, measure_level=False):
-        kwargs_inner = dict({
-            'window_size': -1 if measure_level else 1,
+    def caller_score(outputs, score_tension_bar, ref_score, **kwargs):
+        """Compute the score tension for each (output, window_size) in outputs and at the bar level at once."""
+        kwargs = dict({
             'key_name': '',
             'track_num': 3,
+            'beat_division': 4,
             'end_ratio': .5,
             'key_changed': False,
             'vertical_step': 0.4
-        }, **kwargs_inner)
-        tension = get_tension(ref_midi, columns='time', **kwargs_inner)
-        df_beats = pd.read_csv(perf_beats).tail(-1)  # Drop the first beat as tension is not computed there
-        tension['time'] = df_beats['time']
-        tension.to_csv(perf_tension, sep=',', index=False)
-        write_tension_json(perf_tension, json_file=perf_tension_json)
+        }, **kwargs)
+        kwargs.pop('window_size', None)
+        notes = tc.extract_notes(ref_score, track_num=kwargs['track_num'], beat_division=kwargs['beat_division'],
+                                 resolution=kwargs.get('resolution', 'grid'))
+        outputs = [*outputs, (score_tension_bar, -1)]
+        tensions = tensions_from_notes(notes, [window_size for _, window_size in outputs], columns='time', **kwargs)
+        for score_tension, window_size in outputs:
+            tensions[window_size].to_csv(score_tension, sep=',', index=False)
+        return True
+
+    def caller(outputs, perf_beats, measure_level=False):
+        """Map each score tension to performance time for each (score_tension, output, output_json, window_size)."""
+        df_beats = pd.read_csv(perf_beats)
+        for score_tension, perf_tension, perf_tension_json, window_size in outputs:
+            tension = read_score_tension(score_tension)
+            tension['time'] = window_times(df_beats, 1 if measure_level else window_size)
+            tension.to_csv(perf_tension, sep=',', index=False)
+            write_tension_json(perf_tension, json_file=perf_tension_json)
         return True
 
+    # The score tension does not depend on the performance, so that new beats only redo the time mapping
+    sweep = [(add_suffix(targets("tension_score"), suffix), add_suffix(targets("tension"), suffix),
+              add_suffix(targets("tension_json"), suffix), sweep_kwargs.get('window_size', 1))
+             for suffix, sweep_kwargs in expand_sweep(kwargs, sweep_params)]
+    # Only the window size can be swept, so that all levels and swept values share a single analysis of the score
+    score_kwargs = expand_sweep(kwargs, sweep_params)[0][1]
+    yield {
+        'basename': "tension_score",
+        'file_dep': [ref_score, __file__, tc.__file__],
+        'name': piece_id,
+        'doc': task_docs["tension_score"],
+        'targets': [score_tension for score_tension, *_ in sweep] + [score_tension_bar],
+        'uptodate': [config_changed(kwargs)],
+        'actions': [(caller_score, [[(score_tension, window_size) for score_tension, *_, window_size in sweep],
+                                    score_tension_bar, ref_score], score_kwargs)],
+    }
+
     if targets("manual_beats") is not None or targets("perfmidi") is not None:
         yield {
             'basename': "tension",
-            'file_dep': [ref_midi, perf_beats, __file__, tc.__file__],
+            'file_dep': [score_tension for score_tension, *_ in sweep] + [perf_beats, __file__],
             'name': piece_id,
             'doc': task_docs["tension"],
-            'targets': [perf_tension, perf_tension_json],
-            'uptodate': [config_changed(kwargs)],
-            'actions': [(caller, [perf_tension, perf_tension_json, ref_midi, perf_beats, kwargs])],
+            'targets': [path for _, perf_tension, perf_tension_json, _ in sweep
+                        for path in (perf_tension, perf_tension_json)],
+            'actions': [(caller, [sweep, perf_beats])],
         }
     if targets("manual_bars") is not None or targets("perfmidi") is not None:
         yield {
             'basename': "tension_bar",
-            'file_dep': [ref_midi, perf_bars, __file__, tc.__file__],
+            'file_dep': [score_tension_bar, perf_bars, __file__],
             'name': piece_id,
             'doc': task_docs["tension_bar"],
             'targets': [perf_tension_bar, perf_tension_bar_json],
-            'actions': [(caller, [perf_tension_bar, perf_tension_bar_json, ref_midi, perf_bars, kwargs, True])]
+            'actions': [(caller, [[(score_tension_bar, perf_tension_bar, perf_tension_bar_json, -1)],
+                                  perf_bars, True])]
         }
@@ -1,10 +1,11 @@
 """Miscellaneous functions for music_features."""
 import csv
 import functools
+import itertools
 import os
 import platform
 import json
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 
 
 def read_json(filePath):
@@ -138,16 +139,49 @@ def collect_kw_parameters(*funcs: Callable) -> List[Dict[str, Any]]:
             for func in funcs
             for (param, default) in func.__kwdefaults__.items()]
 
+
+def expand_sweep(kwargs: Dict[str, Any], sweep_params: Iterable[str]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Expand list-valued sweep parameters into one set of parameters per combination of values.
+
+    The combination of the first values comes first with an empty suffix, so that its outputs keep their usual
+    names (and are the ones used by other features); the others get a suffix made of the swept values.
+
+    Args:
+        kwargs (Dict[str, Any]): task parameters, some of which may be lists of values to sweep
+        sweep_params (Iterable[str]): names of the parameters which may be swept
+
+    Returns:
+        List[Tuple[str, Dict[str, Any]]]: (suffix, parameters) pairs, one per combination
+    """
+    swept = {param: values for param, values in kwargs.items() if param in sweep_params and isinstance(values, list)}
+    combinations = []
+    for i, values in enumerate(itertools.product(*swept.values())):
+        combination = dict(zip(swept, values))
+        suffix = "" if i == 0 else "".join(f"_{param}-{value}" for param, value in combination.items())
+        combinations.append((suffix, dict(kwargs, **combination)))
+    return combinations
+
+
+def add_suffix(path: str, suffix: str) -> str:
+    """Insert a suffix in a path before its extension."""
+    path_noext, extension = os.path.splitext(path)
+    return path_noext + suffix + extension
+
+
 default_naming_scheme = {
     # Structure: <type_id>: (<source>, <extension>)
     "beats": ("perfmidi", "_beats.csv"),
     "manual_beats": ("perfmidi", "_beats_manual.csv"),
     "ref_midi": ("score", "_ref.mid"),
+    "ref_score": ("score", "_ref_score.npz"),
     "match": ("perfmidi", "_match.txt"),
     "bars": ("perfmidi", "_bars.csv"),
     "loudness": ("perfmidi", "_loudness_all.csv"),
     "loudness_simple": ("perfmidi", "_loudness.csv"),
     "loudness_resampled": ("perfmidi", "_loudness_resampled.csv"),
+    "loudness_raw": ("perfmidi", "_loudness_raw.npy"),
+    "loudness_bands": ("perfmidi", "_loudness_bands.npy"),
+    "midi_events": ("perfmidi", "_events.npz"),
     "velocity": ("perfmidi", "_velocity.csv"),
     "sustain": ("perfmidi", "_sustain.csv"),
     "tempo": ("perfmidi", "_tempo.csv"),
@@ -166,5 +200,7 @@ default_naming_scheme = {
     "tension": ("perfmidi", "_tension.csv"),
     "tension_bar": ("perfmidi", "_tension_bar.csv"),
     "tension_json": ("perfmidi", "_tension.json"),
-    "tension_bar_json": ("perfmidi", "_tension_bar.json")
+    "tension_bar_json": ("perfmidi", "_tension_bar.json"),
+    "tension_score": ("score", "_tension_score.csv"),
+    "tension_bar_score": ("score", "_tension_bar_score.csv")
 }
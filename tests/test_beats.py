@@ -2,6 +2,7 @@ from music_features import get_beats, get_alignment
 import pytest
 
 import numpy as np
+import pandas as pd
 import helpers
 from music_features.util import targets_factory
 
@@ -50,3 +51,26 @@ def test_reasonable_removal(ref, perf):
     _, removed = get_beats.get_beats(alignment, reference_beats=reference_beats)
 
     assert 20*len(removed) < len(alignment)
+
+
+def test_in_ranges_same_as_per_range():
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 100, 200)
+    starts = rng.integers(0, 100, 10)
+    ends = starts + rng.integers(-5, 20, 10)
+
+    expected = [any(start <= value <= end for start, end in zip(starts, ends)) for value in values]
+    np.testing.assert_array_equal(get_beats.in_ranges(values, starts, ends), expected)
+
+
+def test_correction_removes_misaligned_note():
+    reference_beats = np.arange(0, 20000, 500)
+    score_time = np.arange(0, 20000, 250)
+    alignment = pd.DataFrame({'score_time': score_time, 'note_on': score_time / 1000})
+    alignment.loc[30, 'note_on'] = alignment.note_on[28] + 0.01  # Misaligned right after the previous beat
+
+    beats, removed = get_beats.get_beats(alignment, reference_beats, verbose=False)
+
+    assert 30 in removed.index
+    assert get_beats.find_outliers(beats, verbose=False) == []
+    assert beats.interpolated[beats.time.notna()].any()  # Beats of removed notes are interpolated
@@ -1,8 +1,10 @@
 import os
+import shutil
 
 from music_features import get_loudness
 import numpy as np
 import pytest
+import soundfile as sf
 
 import helpers
 
@@ -28,6 +30,92 @@ def test_raw_same_as_matlab(wav_path, old_path):
     np.testing.assert_allclose(raw_loudness, loudness_table.Loudness, atol=0.01)
 
 
+@pytest.mark.parametrize('wav_path, _', loudness_old_pairs())
+@pytest.mark.parametrize('stream_frames', [1, 7, 1000])
+def test_stream_same_as_batch(wav_path, _, stream_frames):
+    time, raw_loudness = get_loudness.compute_raw_loudness(wav_path)
+    stream_time, stream_loudness = get_loudness.compute_raw_loudness(wav_path, stream_frames=stream_frames)
+
+    np.testing.assert_array_equal(stream_time, time)
+    np.testing.assert_array_equal(stream_loudness, raw_loudness)
+
+
+@pytest.mark.parametrize('wav_path, _', loudness_old_pairs())
+@pytest.mark.parametrize('frame_workers, stream_frames', [(2, 0), (5, 0), (3, 100)])
+def test_parallel_same_as_sequential(wav_path, _, frame_workers, stream_frames):
+    time, raw_loudness = get_loudness.compute_raw_loudness(wav_path)
+    parallel_time, parallel_loudness = get_loudness.compute_raw_loudness(wav_path, frame_workers=frame_workers,
+                                                                         stream_frames=stream_frames)
+
+    np.testing.assert_array_equal(parallel_time, time)
+    np.testing.assert_array_equal(parallel_loudness, raw_loudness)
+
+
+@pytest.mark.parametrize('wav_path, _', loudness_old_pairs())
+@pytest.mark.parametrize('chunk_size', [100, 4096])
+def test_online_same_as_offline(wav_path, _, chunk_size):
+    time, raw_loudness = get_loudness.compute_raw_loudness(wav_path)
+    audio, fs = sf.read(wav_path)
+
+    processor = get_loudness.OnlineLoudness(fs)
+    frames = [frame for start in range(0, len(audio), chunk_size)
+              for frame in processor.push(audio[start:start+chunk_size])]
+
+    np.testing.assert_array_equal([frame.time for frame in frames], time)
+    np.testing.assert_array_equal([frame.loudness for frame in frames], raw_loudness)
+
+
+@pytest.mark.parametrize('wav_path, _', loudness_old_pairs())
+def test_bands_stream_same_as_batch(wav_path, _, clean_dir):
+    batch_path = os.path.join(clean_dir, "batch_bands.npy")
+    stream_path = os.path.join(clean_dir, "stream_bands.npy")
+    time, _ = get_loudness.compute_raw_loudness(wav_path, batch_path)
+    get_loudness.compute_raw_loudness(wav_path, stream_path, stream_frames=100)
+
+    bands = get_loudness.read_loudness_bands(batch_path)
+    assert isinstance(bands, np.memmap)
+    assert bands.shape[1] == len(time)
+    np.testing.assert_array_equal(get_loudness.read_loudness_bands(stream_path), bands)
+
+
+@pytest.mark.parametrize('frame_workers, stream_frames', [(1, 0), (1, 7), (3, 0)])
+def test_shorter_than_one_frame(clean_dir, frame_workers, stream_frames):
+    wav_path = os.path.join(clean_dir, "short.wav")
+    bands_path = os.path.join(clean_dir, "short_bands.npy")
+    sf.write(wav_path, np.zeros(600), 44100)
+
+    time, raw_loudness = get_loudness.compute_raw_loudness(wav_path, bands_path, frame_workers=frame_workers,
+                                                           stream_frames=stream_frames)
+
+    assert time.shape == raw_loudness.shape == (0,)
+    assert get_loudness.read_loudness_bands(bands_path).shape == (24, 0)
+
+
+@pytest.mark.parametrize('wav_path, _', loudness_old_pairs())
+def test_batch_isolates_errors(wav_path, _, clean_dir):
+    shutil.copy(wav_path, clean_dir)
+    with open(os.path.join(clean_dir, "corrupt.wav"), "w") as corrupt_file:
+        corrupt_file.write("not a wav file")
+
+    with pytest.warns(UserWarning):
+        corrupt, loudness = get_loudness.get_loudness(clean_dir, export_loudness=False, workers=2)
+
+    assert corrupt is None
+    time, raw_loudness = get_loudness.compute_raw_loudness(wav_path)
+    np.testing.assert_array_equal(loudness.Time, time)
+    np.testing.assert_array_equal(loudness.Loudness, raw_loudness)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_single_file_raises(clean_dir, workers):
+    corrupt_path = os.path.join(clean_dir, "corrupt.wav")
+    with open(corrupt_path, "w") as corrupt_file:
+        corrupt_file.write("not a wav file")
+
+    with pytest.raises(RuntimeError):
+        get_loudness.get_loudness(corrupt_path, export_loudness=False, workers=workers)
+
+
 @pytest.mark.parametrize('_, old_path', loudness_old_pairs())
 def test_read_write_identity(_, old_path, clean_dir):
     data = get_loudness.read_loudness(old_path)
@@ -119,3 +207,14 @@ def test_smoothing_keeps_size(_, old_file):
     smoothed = get_loudness.smooth(loudness_table.Loudness_norm, 0.03)
 
     assert len(smoothed) == len(loudness_table.Loudness_smooth)
+
+
+@pytest.mark.parametrize('_, old_file', loudness_old_pairs())
+@pytest.mark.parametrize('span', [0.03, 0.1, 51])
+def test_numpy_smoothing_same_as_lowess(_, old_file, span):
+    loudness_table = get_loudness.read_loudness(old_file)
+
+    reference = get_loudness.smooth(loudness_table.Loudness_norm, span, backend='lowess')
+    smoothed = get_loudness.smooth(loudness_table.Loudness_norm, span, backend='numpy')
+
+    np.testing.assert_allclose(smoothed, reference, atol=1e-6)
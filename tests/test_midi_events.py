@@ -0,0 +1,105 @@
+import os
+
+from music_features import get_midi_events, get_onset_velocity, get_sustain
+import mido
+import numpy as np
+import pytest
+
+
+def write_midi(path):
+    midi = mido.MidiFile(ticks_per_beat=480)
+    track = mido.MidiTrack()
+    midi.tracks.append(track)
+    track.append(mido.Message('note_on', note=60, velocity=50, time=0))
+    track.append(mido.Message('note_on', note=60, velocity=60, time=480))
+    track.append(mido.Message('control_change', control=64, value=100, time=0))
+    track.append(mido.Message('note_off', note=60, time=480))
+    track.append(mido.Message('note_on', note=64, velocity=70, time=0))
+    track.append(mido.Message('control_change', control=64, value=0, time=480))
+    track.append(mido.Message('note_on', note=60, velocity=0, time=480))
+    track.append(mido.Message('note_off', note=62, time=0))
+    midi.save(path)
+    return path
+
+
+@pytest.mark.parametrize('backend', ['mido', 'native'])
+def test_note_offs_paired_in_order(clean_dir, backend):
+    midi_path = write_midi(os.path.join(clean_dir, "unbalanced.mid"))
+
+    with pytest.warns(UserWarning, match="unbalanced"):
+        notes, controls = get_midi_events.get_midi_event_table(midi_path, backend=backend)
+
+    np.testing.assert_array_equal(notes['StartTime'], [0, .5, 1])
+    np.testing.assert_array_equal(notes['EndTime'], [1, 2, np.nan])
+    np.testing.assert_array_equal(notes['Velocity'], [50, 60, 70])
+    np.testing.assert_array_equal(controls['Time'], [.5, 1.5])
+
+
+def test_event_list_same_as_tables(clean_dir):
+    midi_path = write_midi(os.path.join(clean_dir, "unbalanced.mid"))
+
+    with pytest.warns(UserWarning):
+        events = get_midi_events.get_midi_events(midi_path)
+        sustain = get_sustain.get_sustain(midi_path)
+        velocities = get_onset_velocity.get_onset_velocity(midi_path)
+
+    assert [event['Type'] for event in events] == ['note_on', 'note_on', 'control_change', 'note_on', 'control_change']
+    assert events[3]['EndTime'] is None
+    assert sustain.values.tolist() == [[event['Time'], event['Value']] for event in events
+                                       if event['Type'] == 'control_change']
+    assert velocities.values.tolist() == [[event['StartTime'], event['Velocity']] for event in events
+                                          if event['Type'] == 'note_on']
+
+
+def test_parsed_once_until_modified(clean_dir):
+    midi_path = write_midi(os.path.join(clean_dir, "unbalanced.mid"))
+
+    with pytest.warns(UserWarning):
+        notes, _ = get_midi_events.get_midi_event_table(midi_path)
+    assert get_midi_events.get_midi_event_table(midi_path)[0] is notes
+    assert not notes.flags.writeable
+
+    mido.MidiFile(tracks=[mido.MidiTrack()]).save(midi_path)
+    assert len(get_midi_events.get_midi_event_table(midi_path)[0]) == 0
+
+
+def test_read_write_identity(clean_dir):
+    midi_path = write_midi(os.path.join(clean_dir, "unbalanced.mid"))
+    table_path = os.path.join(clean_dir, "unbalanced_events.npz")
+
+    with pytest.warns(UserWarning):
+        notes, controls = get_midi_events.get_midi_event_table(midi_path)
+    get_midi_events.write_event_table(table_path, notes, controls)
+    read_notes, read_controls = get_midi_events.read_event_table(table_path)
+
+    # Compared as bytes since unmatched notes have a nan EndTime
+    assert read_notes.dtype == notes.dtype and read_notes.tobytes() == notes.tobytes()
+    assert read_controls.dtype == controls.dtype and read_controls.tobytes() == controls.tobytes()
+
+
+def test_native_same_as_mido(clean_dir):
+    midi_path = os.path.join(clean_dir, "tempo.mid")
+    midi = mido.MidiFile(ticks_per_beat=384)
+    tempo_track, track = mido.MidiTrack(), mido.MidiTrack()
+    midi.tracks.extend((tempo_track, track))
+    tempo_track.append(mido.MetaMessage('set_tempo', tempo=600000, time=0))
+    tempo_track.append(mido.MetaMessage('set_tempo', tempo=400000, time=1000))
+    for step in range(50):
+        # Consecutive messages with the same status are written with running status
+        track.append(mido.Message('note_on', note=60 + step % 5, velocity=40 + step, time=70))
+        track.append(mido.Message('control_change', control=64, value=2 * step, time=3))
+        track.append(mido.Message('control_change', control=67, value=step, time=0))
+        track.append(mido.Message('note_on', note=60 + step % 5, velocity=0, time=50))
+        track.append(mido.MetaMessage('text', text="marker", time=1))
+    midi.save(midi_path)
+
+    notes, controls = get_midi_events.parse_midi_event_table(midi_path, backend='mido')
+    native_notes, native_controls = get_midi_events.parse_midi_event_table(midi_path, backend='native')
+
+    np.testing.assert_array_equal(native_notes, notes)
+    np.testing.assert_array_equal(native_controls, controls)
+    # Times as played back by mido, which merges the tracks and follows the tempo changes
+    playback = zip(np.cumsum([message.time for message in midi]), midi)
+    playback_times = [time for time, message in playback if message.type == 'control_change'
+                      or message.type == 'note_on' and message.velocity > 0]
+    np.testing.assert_allclose(np.sort(np.concatenate((notes['StartTime'], controls['Time']))), playback_times)
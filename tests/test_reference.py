@@ -0,0 +1,54 @@
+import itertools
+import os
+
+from music_features import get_beats, get_reference, get_tension
+import numpy as np
+import pandas as pd
+import pretty_midi
+import pytest
+
+
+def write_score(path):
+    pm = pretty_midi.PrettyMIDI(initial_tempo=100)
+    for end in (5, 31.3, 12):
+        instrument = pretty_midi.Instrument(0)
+        instrument.notes = [pretty_midi.Note(64, 60 + i % 12, start, min(start + 1, end))
+                            for i, start in enumerate(np.arange(0, end, 0.7))]
+        instrument.control_changes = [pretty_midi.ControlChange(64, 127, 1), pretty_midi.ControlChange(64, 0, 3)]
+        pm.instruments.append(instrument)
+    pm.time_signature_changes = [pretty_midi.TimeSignature(3, 4, 0), pretty_midi.TimeSignature(6, 8, 10.8),
+                                 pretty_midi.TimeSignature(4, 4, 20.4)]
+    pm.write(path)
+    return path
+
+
+def test_beats_until_same_as_pretty_midi(clean_dir):
+    midi_path = write_score(os.path.join(clean_dir, "score.mid"))
+    reference = get_reference.get_reference(midi_path)
+
+    for kept in itertools.chain.from_iterable(itertools.combinations(range(3), count) for count in range(4)):
+        pm = pretty_midi.PrettyMIDI(midi_path)
+        pm.instruments = [pm.instruments[index] for index in kept]
+
+        beats, downbeats = get_reference.beats_until(
+            reference, max((instrument.get_end_time() for instrument in pm.instruments), default=0.))
+
+        np.testing.assert_array_equal(beats, pm.get_beats())
+        np.testing.assert_array_equal(downbeats, pm.get_downbeats())
+
+
+@pytest.mark.parametrize('track_num', [0, 1, 2])
+def test_reference_file_same_as_midi(clean_dir, track_num):
+    midi_path = write_score(os.path.join(clean_dir, "score.mid"))
+    reference_path = os.path.join(clean_dir, "score_ref_score.npz")
+    get_reference.write_reference(reference_path, get_reference.extract_reference(midi_path))
+
+    np.testing.assert_array_equal(get_beats.get_beat_reference_pm(reference_path),
+                                  np.round(pretty_midi.PrettyMIDI(midi_path).get_beats() * 1000))
+    np.testing.assert_array_equal(get_beats.get_bar_reference_pm(reference_path),
+                                  np.round(pretty_midi.PrettyMIDI(midi_path).get_downbeats() * 1000))
+    for window_size in (1, -1):
+        pd.testing.assert_frame_equal(get_tension.get_tension(reference_path, window_size=window_size,
+                                                              track_num=track_num),
+                                      get_tension.get_tension(midi_path, window_size=window_size,
+                                                              track_num=track_num))
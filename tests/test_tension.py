@@ -0,0 +1,244 @@
+import os
+
+from music_features import _tension_calculation as tc
+from music_features import get_tension
+import numpy as np
+import pandas as pd
+import pretty_midi
+import pytest
+import scipy.sparse
+
+
+def random_piano_roll(steps=200, density=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((128, steps)) < density).astype(int)
+
+
+def reference_centroid(notes, shift):
+    positions = [tc.pitch_index_to_position(tc.note_index_to_pitch_index[(index % 12 - shift) % 12])
+                 for index, note in enumerate(notes) if note > 0]
+    return np.mean(positions, axis=0) if positions else np.zeros(3)
+
+
+@pytest.mark.parametrize('key_change_beat, changed_shift', [(-1, -1), (10, 5)])
+def test_centroid_same_as_per_step(key_change_beat, changed_shift):
+    piano_roll = random_piano_roll()
+    piano_roll[:, 3] = 0  # Silent step
+
+    centroids = tc.cal_centroid(piano_roll, 2, key_change_beat, changed_shift)
+
+    expected = [reference_centroid(piano_roll[:, step],
+                                   changed_shift if key_change_beat != -1 and step / 4 > key_change_beat else 2)
+                for step in range(piano_roll.shape[1])]
+    np.testing.assert_allclose(centroids, expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('key_change_beat, changed_shift', [(-1, -1), (10, 5)])
+def test_diameter_same_as_per_step(key_change_beat, changed_shift):
+    piano_roll = random_piano_roll(density=0.02)
+    piano_roll[:, 3] = 0  # Silent step
+    piano_roll[[60, 72], 4] = 1  # Octave only
+
+    diameters = tc.cal_diameter(piano_roll, 2, key_change_beat, changed_shift)
+
+    expected = []
+    for step in range(piano_roll.shape[1]):
+        shift = changed_shift if key_change_beat != -1 and step / 4 > key_change_beat else 2
+        pitches = [tc.note_index_to_pitch_index[(index % 12 - shift) % 12]
+                   for index in np.flatnonzero(piano_roll[:, step])]
+        expected.append(tc.largest_distance(pitches))
+    np.testing.assert_array_equal(diameters, expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_key_same_as_per_key_centroids(seed):
+    piano_roll = random_piano_roll(density=0.03, seed=seed)
+
+    key_name, key_pos, key_shift = tc.cal_key(piano_roll, tc.all_key_names, end_ratio=0.5)
+
+    key_positions, key_shifts, _ = tc.key_table(tuple(tc.all_key_names))
+    distances = [np.linalg.norm(tc.piano_roll_to_ce(piano_roll[:, :100], shift) - position)
+                 for position, shift in zip(key_positions, key_shifts)]
+    assert key_name == tc.all_key_names[np.argmin(distances)]
+    np.testing.assert_array_equal(key_pos, key_positions[np.argmin(distances)])
+    assert key_shift == key_shifts[np.argmin(distances)]
+
+
+def test_key_after_change():
+    sixteenth_time = np.arange(64) / 8
+    piano_roll = np.zeros((128, 64), dtype=int)
+    piano_roll[[60, 64, 67], :32] = 1  # C major triad
+    piano_roll[[61, 66, 70], 32:] = 1  # F# major triad
+
+    key_name, _, _ = tc.get_key_index_change(piano_roll, sixteenth_time[32], sixteenth_time)
+
+    assert key_name == tc.cal_key(piano_roll[:, 32:], tc.all_key_names, end_ratio=1)[0]
+    assert key_name != tc.cal_key(piano_roll, tc.all_key_names, end_ratio=0.5)[0]
+
+
+@pytest.mark.parametrize('window_size', [-1, 1, 2, 3])
+def test_merge_same_as_window_means(window_size):
+    rng = np.random.default_rng(0)
+    metric = rng.random((300, 3))
+    beat_indices = np.arange(0, 300, 4)
+    down_beat_indices = beat_indices[::3]
+
+    merged = tc.merge_tension(metric, beat_indices, down_beat_indices, window_size)
+
+    boundaries = down_beat_indices if window_size == -1 else beat_indices[::window_size]
+    expected = [np.mean(metric[start:end], axis=0) for start, end in zip(boundaries[:-1], boundaries[1:])]
+    if window_size != -1:
+        expected = expected[:len(range(0, len(beat_indices) - window_size, window_size))]
+    np.testing.assert_allclose(merged, expected, rtol=1e-13)
+
+
+def test_moving_average_same_as_window_means():
+    tension = np.random.default_rng(0).random(50)
+
+    padded = np.concatenate([tension, np.zeros(4)])
+    expected = [np.mean(padded[i:i+4]) for i in range(len(tension) + 1)]
+    np.testing.assert_array_equal(tc.moving_average(tension, 4), expected)
+
+
+def test_key_change_after_silence():
+    key_diff = np.ones(60)
+    key_diff[20:24] = 0  # Silent bars are filled with a ratio of one
+    key_diff[40:] = 4
+
+    assert tc.detect_key_change(key_diff, None, start_ratio=0.5) == 39
+    assert tc.detect_key_change(np.ones(60), None, start_ratio=0.5) == -1
+
+
+def random_score(seed=0):
+    rng = np.random.default_rng(seed)
+    pm = pretty_midi.PrettyMIDI()
+    for _ in range(2):
+        instrument = pretty_midi.Instrument(0)
+        for _ in range(300):
+            start = rng.uniform(0, 30)
+            instrument.notes.append(pretty_midi.Note(64, int(rng.integers(21, 109)), start,
+                                                     start + rng.choice([0.001, 0.1, 1.5])))
+        for time in np.sort(rng.uniform(0, 30, 20)):  # Sustain pedal
+            instrument.control_changes.append(pretty_midi.ControlChange(64, int(rng.choice([0, 127])), time))
+        pm.instruments.append(instrument)
+    return pm
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_piano_roll_same_as_pretty_midi(seed):
+    pm = random_score(seed)
+    times = np.linspace(0, 35, 500)
+
+    piano_roll = tc.get_piano_roll(pm, times)
+
+    assert piano_roll.dtype == np.uint8
+    np.testing.assert_array_equal(piano_roll.toarray(), pm.get_piano_roll(times=times) > 0)
+
+
+def test_sparse_same_as_dense():
+    dense = random_piano_roll()
+    sparse = scipy.sparse.csc_matrix(dense, dtype=np.uint8)
+
+    np.testing.assert_allclose(tc.cal_centroid(sparse, 2, 10, 5), tc.cal_centroid(dense, 2, 10, 5), atol=1e-12)
+    np.testing.assert_array_equal(tc.cal_diameter(sparse, 2, 10, 5), tc.cal_diameter(dense, 2, 10, 5))
+    assert tc.cal_key(sparse, tc.all_key_names)[0] == tc.cal_key(dense, tc.all_key_names)[0]
+    np.testing.assert_array_equal(tc.note_to_index(sparse), tc.note_to_index(dense))
+
+
+@pytest.mark.parametrize('beat_division', [1, 3, 4])
+def test_beat_grid(beat_division):
+    pm = random_score()
+
+    divided_beats, beats, down_beats, beat_indices, down_beat_indices = tc.get_beat_time(pm, beat_division)
+
+    expected = [(beats[i + 1] - beats[i]) / beat_division * j + beats[i]
+                for i in range(len(beats) - 1) for j in range(beat_division)]
+    np.testing.assert_array_equal(divided_beats, np.unique([*expected, beats[-1]]))
+    np.testing.assert_array_equal(divided_beats[beat_indices], beats)
+    np.testing.assert_array_equal(down_beat_indices, [np.argmin(np.abs(down_beat - divided_beats))
+                                                      for down_beat in down_beats])
+
+
+def test_beat_and_bar_tension_same_as_separate(clean_dir):
+    midi_path = os.path.join(clean_dir, 'score.mid')
+    random_score().write(midi_path)
+
+    beat_tension, bar_tension = get_tension.get_beat_and_bar_tension(midi_path, window_size=2)
+
+    pd.testing.assert_frame_equal(beat_tension, get_tension.get_tension(midi_path, window_size=2))
+    pd.testing.assert_frame_equal(bar_tension, get_tension.get_tension(midi_path, window_size=-1))
+
+
+def test_time_window_means():
+    boundaries = np.array([1., 2., 4., 5.])
+    values = np.array([3., 0., 6.])
+
+    means = tc.time_window_means(values, boundaries, [0, 1, 1.5, 3, 6, 2], [2, 5, 2.5, 4.5, 7, 2])
+
+    np.testing.assert_allclose(means, [1.5, 9 / 4, 1.5, 6 * .5 / 1.5, 0, np.nan])
+
+
+def test_event_tension_same_windows_as_grid(clean_dir):
+    midi_path = os.path.join(clean_dir, 'score.mid')
+    random_score().write(midi_path)
+
+    for window_size in (1, 2, -1):
+        grid_tension = get_tension.get_tension(midi_path, window_size=window_size)
+        event_tension = get_tension.get_tension(midi_path, window_size=window_size, resolution='events')
+
+        pd.testing.assert_series_equal(event_tension['time'], grid_tension['time'])
+        for column in ('diameter', 'strain', 'momentum'):
+            assert np.corrcoef(event_tension[column], grid_tension[column])[0, 1] > 0.9
+
+
+def modulating_score():
+    pm = pretty_midi.PrettyMIDI(initial_tempo=120)
+    instrument = pretty_midi.Instrument(0)
+    progression = [(0, 4, 7), (5, 9, 12), (7, 11, 14), (0, 4, 7)]  # I IV V I
+    for bar in range(40):
+        tonic = 60 if bar < 20 else 66  # Up a tritone halfway
+        for beat, chord in enumerate(progression):
+            start = (bar * 4 + beat) * .5
+            instrument.notes.extend(pretty_midi.Note(64, tonic + interval, start, start + .5) for interval in chord)
+    pm.instruments.append(instrument)
+    return pm
+
+
+def test_event_key_change_same_as_grid(clean_dir):
+    midi_path = os.path.join(clean_dir, 'score.mid')
+    modulating_score().write(midi_path)
+    pm, piano_roll, beat_data = tc.extract_notes(midi_path, track_num=3)
+
+    grid_time, grid_strain, grid_diameter, grid_momentum, grid_key, grid_kc = tc.cal_tension_windows(
+        pm, piano_roll, beat_data, (1,), key_changed=True)[1]
+    time, strain, diameter, momentum, key, kc = tc.cal_tension_events(pm, beat_data, (1,), key_changed=True)[1]
+
+    assert kc['key_change_bar'] != -1 and kc['changed_key_name'] != key
+    assert (key, kc['changed_key_name'], kc['key_change_bar']) == (grid_key, grid_kc['changed_key_name'],
+                                                                   grid_kc['key_change_bar'])
+    np.testing.assert_array_equal(time, grid_time)
+    # The grid only re-keys the steps after the first one of the change beat
+    change = kc['key_change_beat']
+    for values, grid_values in ((strain, grid_strain), (diameter, grid_diameter), (momentum, grid_momentum)):
+        np.testing.assert_allclose(np.delete(values, [change, change + 1]),
+                                   np.delete(grid_values, [change, change + 1]), atol=1e-12)
+    # Post-change centroids are placed relative to the new key, e.g. for its tonic chord
+    tonic_chord = np.zeros((128, 1))
+    tonic_chord[[66, 70, 73]] = 1
+    tonic_centroid = tc.cal_centroid(tonic_chord, kc['changed_note_shift'])[0]
+    assert strain[-4] == pytest.approx(np.linalg.norm(tonic_centroid - kc['changed_key_pos']))
+
+
+def test_note_segments_same_as_pretty_midi():
+    pm = random_score()
+    pm.instruments[0].pitch_bends = [pretty_midi.PitchBend(pitch, time) for pitch, time in
+                                     [(2000, 3.), (0, 7.5), (-4000, 12.), (8191, 20.), (0, 25.)]]
+
+    boundaries, piano_roll = tc.get_note_segments(pm)
+
+    # Each frame of the pretty_midi piano roll falls in exactly one segment
+    frames = np.round(boundaries * 100).astype(int)
+    expected = pm.get_piano_roll(fs=100) > 0
+    segment_of_frames = np.searchsorted(frames, np.arange(frames[0], frames[-1]), side='right') - 1
+    np.testing.assert_array_equal(piano_roll.toarray()[:, segment_of_frames] > 0, expected[:, frames[0]:frames[-1]])
+    assert not expected[:, :frames[0]].any() and not expected[:, frames[-1]:].any()